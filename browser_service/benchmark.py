@@ -0,0 +1,394 @@
+# benchmark.py
+"""Offline benchmark for the browser agent service.
+
+Runs the FastAPI app in-process against a scripted stand-in chat model and a
+locally served fixture website, so no LLM provider or public site is involved.
+Reports session create latency, end-to-end command latency percentiles,
+commands/sec at N concurrent sessions and peak RSS of the service and its
+browsers, as JSON for tracking regressions across commits.
+
+    python benchmark.py --sessions 4 --commands 5 --output bench.json
+    python benchmark.py --browser cdp --chrome /usr/bin/chromium
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+
+import httpx
+import uvicorn
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import server  # noqa: E402
+
+# Fixture website served on localhost
+FIXTURE_PAGES = {
+    "/": """<html><head><title>Fixture Home</title></head><body>
+<h1>Patient Portal</h1>
+<a href="/patients/3">Patient 3</a>
+<form><input name="q" placeholder="Search"><button type="submit">Search</button></form>
+</body></html>""",
+    "/patients/3": """<html><head><title>Patient 3</title></head><body>
+<h1>Patient 3</h1>
+<table><tr><th>Name</th><td>Jane Doe</td></tr><tr><th>DOB</th><td>1980-01-01</td></tr></table>
+<p>""" + " ".join(["Intake form text."] * 200) + """</p>
+</body></html>""",
+}
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        page = FIXTURE_PAGES.get(self.path.split("?")[0])
+        body = (page or "<html><body>Not found</body></html>").encode()
+        self.send_response(200 if page else 404)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_fixture_site() -> str:
+    """Serve the fixture pages from a background thread and return the base URL"""
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+class ScriptedChatModel(BaseChatModel):
+    """Deterministic stand-in for a tool-calling chat model.
+
+    Answers every agent step with a scripted AgentOutput tool call: open the
+    first URL in the task, scroll `extra_steps` times, then finish.
+    """
+
+    latency: float = 0.0
+    extra_steps: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def _script(self, messages) -> List[Dict[str, Any]]:
+        task = next((m.content for m in messages if isinstance(m, HumanMessage)
+                     and isinstance(m.content, str) and "ultimate task" in m.content), "")
+        quoted = re.search(r'"""(.*?)"""', task, re.S)
+        task = quoted.group(1) if quoted else task
+        url = re.search(r"https?://[^\s\"']+", task)
+        steps = [{"go_to_url": {"url": url.group(0) if url else "about:blank"}}]
+        steps += [{"scroll_down": {}}] * self.extra_steps
+        steps.append({"done": {"text": f"Finished: {task[:80]}"}})
+        return steps
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        tools = kwargs.get("tools") or [{"function": {"name": "AgentOutput"}}]
+        # The agent's message history starts with one example tool call
+        previous_calls = sum(1 for m in messages if isinstance(m, AIMessage) and m.tool_calls) - 1
+        script = self._script(messages)
+        action = script[min(max(previous_calls, 0), len(script) - 1)]
+        tool_call = {
+            "name": tools[0]["function"]["name"],
+            "args": {
+                "current_state": {
+                    "page_summary": "",
+                    "evaluation_previous_goal": "Success",
+                    "memory": f"Step {previous_calls + 1} of {len(script)}",
+                    "next_goal": next(iter(action)),
+                },
+                "action": [action],
+            },
+            "id": str(uuid.uuid4()),
+            "type": "tool_call",
+        }
+        message = AIMessage(content="", tool_calls=[tool_call],
+                            usage_metadata={"input_tokens": 1000, "output_tokens": 50, "total_tokens": 1050})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def launch_chrome(chrome_path: str) -> tuple:
+    """Start a headless Chrome with remote debugging and return (process, cdp_url, profile_dir)"""
+    port = free_port()
+    profile_dir = tempfile.mkdtemp(prefix="benchmark-chrome-")
+    process = subprocess.Popen(
+        [chrome_path, "--headless=new", "--no-sandbox", "--no-first-run",
+         f"--remote-debugging-port={port}", f"--user-data-dir={profile_dir}", "about:blank"],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    cdp_url = f"http://127.0.0.1:{port}"
+    for _ in range(50):
+        try:
+            if httpx.get(f"{cdp_url}/json/version", timeout=1).status_code == 200:
+                return process, cdp_url, profile_dir
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Chrome did not start at {chrome_path}")
+
+def process_tree_rss() -> int:
+    """Resident memory in bytes of this process and all its descendants (Linux /proc)"""
+    children: Dict[int, List[int]] = {}
+    rss_pages: Dict[int, int] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+            with open(f"/proc/{entry}/statm") as f:
+                rss_pages[int(entry)] = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    stack = [os.getpid()]
+    while stack:
+        pid = stack.pop()
+        total += rss_pages.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total * os.sysconf("SC_PAGE_SIZE")
+
+class RSSSampler:
+    """Samples process tree RSS in the background and keeps the peak"""
+
+    def __init__(self, interval: float = 0.2):
+        self.interval = interval
+        self.peak = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, await asyncio.to_thread(process_tree_rss))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if os.path.isdir("/proc"):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+            self.peak = max(self.peak, process_tree_rss())
+
+def summarize(samples: List[float]) -> Dict[str, Any]:
+    """Count, mean and nearest-rank percentiles of latency samples in seconds"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "min": ordered[0],
+        "p50": percentile(50),
+        "p90": percentile(90),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": ordered[-1],
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def configure_service(args, cdp_url: Optional[str]):
+    """Point the service at the scripted model and the benchmark's browsers"""
+    server.create_llm = lambda provider, model, temperature: server.managed_llm_class(ScriptedChatModel)(
+        latency=args.llm_latency, extra_steps=args.steps
+    )
+    server.clear_llm_cache()
+
+    if args.browser == "playwright":
+        def get_browser():
+            browser_use = server.lazy_import("browser_use")
+            return browser_use.Browser(config=browser_use.BrowserConfig(headless=True))
+        server.get_browser = get_browser
+    elif args.browser == "cdp":
+        server.CONNECTION_MODE = "cdp"
+        server.CHROME_CDP_URL = cdp_url
+
+    server.BROWSER_SHARING_MODE = args.sharing_mode
+    server.browser_pool = server.BrowserPool(min_size=args.pool_min, max_size=max(args.pool_max, args.sessions))
+    server.scheduler = server.AgentScheduler(max_agents=args.max_agents or args.sessions)
+    # Every sample repeats one prompt, so replays and shared runs would stand in for agent runs
+    server.ACTION_CACHE_ENABLED = False
+    server.command_coalescer = server.CommandCoalescer(ttl=0)
+
+async def run_command(client: httpx.AsyncClient, session_id: str, prompt: str) -> tuple:
+    """Submit a command and long-poll until it finishes; returns (latency, succeeded)"""
+    started = time.perf_counter()
+    response = await client.post(f"/browser-agent/{session_id}/command", json={"prompt": prompt})
+    response.raise_for_status()
+    command_id = response.json()["command_id"]
+    while True:
+        response = await client.get(f"/browser-agent/{session_id}/commands/{command_id}", params={"wait": 30})
+        response.raise_for_status()
+        state = response.json()
+        if state["state"] == "completed":
+            return time.perf_counter() - started, state["result"]["status"] == "success"
+
+async def wait_until_serving(uvicorn_server: uvicorn.Server, serve_task: asyncio.Task, timeout: float = 30.0):
+    """Wait for uvicorn to start; raises if it exits first (bind error, failed startup hook) or takes too long"""
+    deadline = time.monotonic() + timeout
+    while not uvicorn_server.started:
+        if serve_task.done():
+            error = None if serve_task.cancelled() else serve_task.exception()
+            raise RuntimeError("Service exited before it started serving") from error
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Service did not start serving within {timeout}s")
+        await asyncio.sleep(0.05)
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    fixture_url = start_fixture_site()
+    chrome = None
+    if args.browser == "cdp" and not args.cdp_url:
+        chrome = launch_chrome(args.chrome)
+    configure_service(args, args.cdp_url or (chrome[1] if chrome else None))
+
+    port = free_port()
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=port, log_level="warning"))
+    serve_task = asyncio.create_task(uvicorn_server.serve())
+    sampler = RSSSampler()
+    try:
+        await wait_until_serving(uvicorn_server, serve_task)
+        sampler.start()
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120) as client:
+            # Session create latency, one session at a time
+            create_latencies = []
+            for _ in range(args.create_samples):
+                started = time.perf_counter()
+                response = await client.post("/browser-agent/session", json={})
+                response.raise_for_status()
+                create_latencies.append(time.perf_counter() - started)
+                await client.delete(f"/browser-agent/{response.json()['session_id']}")
+
+            # Throughput: N sessions, each running its commands back to back
+            session_ids = []
+            for _ in range(args.sessions):
+                response = await client.post("/browser-agent/session", json={})
+                response.raise_for_status()
+                session_ids.append(response.json()["session_id"])
+
+            prompt = f"go to {fixture_url}/patients/3 and return the page text"
+            command_latencies: List[float] = []
+            failures = 0
+
+            async def drive(session_id: str):
+                nonlocal failures
+                for _ in range(args.commands):
+                    latency, succeeded = await run_command(client, session_id, prompt)
+                    command_latencies.append(latency)
+                    failures += 0 if succeeded else 1
+
+            started = time.perf_counter()
+            await asyncio.gather(*(drive(session_id) for session_id in session_ids))
+            elapsed = time.perf_counter() - started
+
+            pool_stats = (await client.get("/browser-agent/pool")).json()
+            scheduler_stats = (await client.get("/browser-agent/scheduler")).json()
+            for session_id in session_ids:
+                await client.delete(f"/browser-agent/{session_id}")
+    finally:
+        await sampler.stop()
+        uvicorn_server.should_exit = True
+        await serve_task
+        if chrome:
+            chrome[0].kill()
+            shutil.rmtree(chrome[2], ignore_errors=True)
+
+    total = len(command_latencies)
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "config": {
+            "browser": args.browser,
+            "sharing_mode": args.sharing_mode,
+            "sessions": args.sessions,
+            "commands_per_session": args.commands,
+            "agent_steps_per_command": args.steps + 2,
+            "llm_latency": args.llm_latency,
+            "max_agents": server.scheduler.max_agents,
+            "pool_min": args.pool_min,
+        },
+        "session_create": summarize(create_latencies),
+        "command_latency": summarize(command_latencies),
+        "throughput": {
+            "commands": total,
+            "failed": failures,
+            "elapsed": elapsed,
+            "commands_per_sec": total / elapsed if elapsed else 0.0,
+        },
+        "peak_rss_mb": sampler.peak / (1024 * 1024) if sampler.peak else None,
+        "pool": pool_stats,
+        "scheduler": scheduler_stats,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for the browser agent service")
+    parser.add_argument("--sessions", type=int, default=4, help="concurrent sessions in the throughput phase")
+    parser.add_argument("--commands", type=int, default=5, help="commands run by each session")
+    parser.add_argument("--steps", type=int, default=0, help="extra scripted agent steps per command")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated seconds per LLM call")
+    parser.add_argument("--create-samples", type=int, default=10, help="sessions created for the create latency phase")
+    parser.add_argument("--max-agents", type=int, default=0, help="scheduler agent limit (default: --sessions)")
+    parser.add_argument("--pool-min", type=int, default=1, help="idle browsers kept warm")
+    parser.add_argument("--pool-max", type=int, default=10, help="maximum pooled browsers")
+    parser.add_argument("--sharing-mode", choices=["dedicated", "context"], default="dedicated")
+    parser.add_argument("--browser", choices=["playwright", "cdp", "service"], default="playwright",
+                        help="playwright: bundled headless Chromium; cdp: headless Chrome from --chrome or "
+                             "--cdp-url; service: the service's own CONNECTION_MODE settings")
+    parser.add_argument("--chrome", default=shutil.which("chromium") or shutil.which("google-chrome"),
+                        help="Chrome executable for --browser cdp")
+    parser.add_argument("--cdp-url", help="existing Chrome to attach to for --browser cdp")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmark(args))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
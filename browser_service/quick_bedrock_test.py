@@ -2,6 +2,7 @@
 
 import boto3
 import json
+import time
 
 from botocore.exceptions import ClientError
 
@@ -28,10 +29,12 @@ body = json.dumps({
 
 try:
     # Invoke the model with the request.
+    started = time.perf_counter()
     response = client.invoke_model(modelId=model_id, body=body)
 
     # Read the response body.
     model_response = json.loads(response["body"].read())
+    print(f"Full completion: {time.perf_counter() - started:.2f}s\n")
     
     # Extract choices.
     choices = model_response["choices"]
@@ -41,6 +44,20 @@ try:
         print(f"Choice {index + 1}\n----------")
         print(f"Text:\n{choice['text']}\n")
         print(f"Stop reason: {choice['stop_reason']}\n")
+
+    # Stream the same request to see how long the first token takes.
+    started = time.perf_counter()
+    first_token = None
+    text = ""
+    response = client.invoke_model_with_response_stream(modelId=model_id, body=body)
+    for event in response["body"]:
+        chunk = json.loads(event["chunk"]["bytes"])
+        if first_token is None:
+            first_token = time.perf_counter() - started
+        text += "".join(choice.get("text", "") for choice in chunk.get("choices", []))
+    total = time.perf_counter() - started
+    print(f"Streamed: first token after {first_token:.2f}s, full completion after {total:.2f}s")
+    print(f"Text:\n{text}\n")
 except (ClientError, Exception) as e:
     print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
     exit(1)
@@ -1,21 +1,58 @@
-from fastapi import FastAPI, HTTPException, WebSocket
-from fastapi.responses import HTMLResponse
+import time
+_MODULE_LOAD_STARTED = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, Header, Request
+from fastapi.responses import HTMLResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
-from pydantic import BaseModel
-from langchain_aws import ChatBedrock
-import boto3
-from typing import Optional, Dict, List, Any, Literal
+from pydantic import BaseModel, PrivateAttr
+from typing import Optional, Dict, List, Any, Literal, TYPE_CHECKING
 import json
+import gzip
+import logging
+import logging.handlers
+import queue
+import random
+import contextvars
+import atexit
 from datetime import datetime
 import os
-from browser_use import Agent, Browser, BrowserConfig
-from langchain_openai import ChatOpenAI
-from langchain_ollama import ChatOllama
+import sys
+import importlib
+import functools
 from collections import deque
 import uuid
 import asyncio
 import platform
+import itertools
+import math
+import re
+import dataclasses
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from contextlib import asynccontextmanager
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from opentelemetry import context as otel_context, propagate, trace
+from opentelemetry.trace import StatusCode
+
+# Provider SDKs and browser_use are heavy; they are imported on first use
+# through lazy_import() so startup and OpenAPI export stay fast
+if TYPE_CHECKING:
+    from browser_use import AgentHistoryList, Browser
+    from browser_use.browser.context import BrowserContext
+
+# Seconds spent importing each lazily loaded module
+IMPORT_TIMINGS: Dict[str, float] = {}
+
+def lazy_import(module_name: str):
+    """Import a module on first use and record how long it took"""
+    module = sys.modules.get(module_name)
+    if module is None:
+        started = time.perf_counter()
+        module = importlib.import_module(module_name)
+        IMPORT_TIMINGS[module_name] = time.perf_counter() - started
+        logger.info("Imported module", extra={"module_name": module_name, "seconds": IMPORT_TIMINGS[module_name]})
+    return module
 
 app = FastAPI(title="Browser Agent", description="A service that orchestrates browser agents given commands.")
 
@@ -26,15 +63,18 @@ static_dir = os.path.join(current_dir, "static")
 # Create static directory if it doesn't exist
 os.makedirs(static_dir, exist_ok=True)
 
-# Load default prompts
+# Default prompts are loaded the first time the debug UI is rendered
 default_prompts_path = os.path.join(static_dir, "default_prompts.json")
-DEFAULT_PROMPTS = []
-try:
-    with open(default_prompts_path, 'r') as f:
-        DEFAULT_PROMPTS = json.load(f)["prompts"]
-except Exception as e:
-    print(f"Error loading default prompts: {e}")
-    DEFAULT_PROMPTS = []
+
+@functools.lru_cache(maxsize=None)
+def get_default_prompts() -> List[Dict[str, Any]]:
+    """Load the default saved prompts shown in the debug UI"""
+    try:
+        with open(default_prompts_path, 'r') as f:
+            return json.load(f)["prompts"]
+    except Exception as e:
+        logger.warning("Error loading default prompts", extra={"error": str(e)})
+        return []
 
 # Mount static files directory at both paths
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
@@ -48,37 +88,919 @@ CHROME_CDP_URL = os.getenv('CHROME_CDP_URL', f'http://{CHROME_HOST}:{CHROME_PORT
 HEADLESS = os.getenv('HEADLESS', 'False').lower() == 'true'
 DEBUG = os.getenv('DEBUG', 'False').lower() == 'true'
 
+# Structured logging: one JSON object per line, written by a background thread
+# so the event loop never blocks on stdout. DEBUG switches on debug-level logs.
+LOG_MAX_FIELD_LENGTH = int(os.getenv('LOG_MAX_FIELD_LENGTH', '2000'))
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1.0'))
+
+# Ids stamped onto every log line written while handling a session or command
+log_session_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('log_session_id', default=None)
+log_command_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('log_command_id', default=None)
+
+_LOG_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+def truncate_log_value(value: Any) -> Any:
+    """Keep a log field JSON-friendly and no longer than LOG_MAX_FIELD_LENGTH characters"""
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    text = value if isinstance(value, str) else json.dumps(value, default=str)
+    if len(text) <= LOG_MAX_FIELD_LENGTH:
+        return value if isinstance(value, (str, dict, list)) else text
+    return f"{text[:LOG_MAX_FIELD_LENGTH]}... [truncated {len(text) - LOG_MAX_FIELD_LENGTH} chars]"
+
+class JsonLogFormatter(logging.Formatter):
+    """Formats a record and its `extra` fields as a single JSON line"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": truncate_log_value(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_FIELDS:
+                entry[key] = truncate_log_value(value)
+        if record.exc_info:
+            entry["exception"] = truncate_log_value(self.formatException(record.exc_info))
+        return json.dumps(entry, default=str)
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the writer thread, tagged with the current session and command"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Formatting happens on the writer thread, not here on the event loop
+        return record
+
+    def emit(self, record: logging.LogRecord):
+        if record.levelno <= logging.DEBUG and LOG_DEBUG_SAMPLE_RATE < 1 and random.random() >= LOG_DEBUG_SAMPLE_RATE:
+            return
+        if getattr(record, 'session_id', None) is None:
+            record.session_id = log_session_id.get()
+        if getattr(record, 'command_id', None) is None:
+            record.command_id = log_command_id.get()
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            record.trace_id = trace.format_trace_id(span_context.trace_id)
+            record.span_id = trace.format_span_id(span_context.span_id)
+        super().emit(record)
+
+def setup_logging() -> logging.Logger:
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonLogFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    service_logger = logging.getLogger('browser_service')
+    service_logger.handlers = [ContextQueueHandler(log_queue)]
+    service_logger.propagate = False
+    service_logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+    return service_logger
+
+logger = setup_logging()
+
+# Tracing
+TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'none')  # Options: none, console, file, otlp
+TRACING_FILE = os.getenv('TRACING_FILE', './logs/traces.jsonl')
+
+def setup_tracing() -> "trace.Tracer":
+    """Export spans with TRACING_EXPORTER; with none, spans are no-ops"""
+    if TRACING_EXPORTER == 'none':
+        return trace.get_tracer('browser_service')
+    sdk_trace = lazy_import('opentelemetry.sdk.trace')
+    sdk_export = lazy_import('opentelemetry.sdk.trace.export')
+    resource = lazy_import('opentelemetry.sdk.resources').Resource.create({"service.name": "browser-service"})
+    if TRACING_EXPORTER == 'otlp':
+        # Optional dependency; configured with the standard OTEL_EXPORTER_OTLP_* variables
+        exporter = lazy_import('opentelemetry.exporter.otlp.proto.http.trace_exporter').OTLPSpanExporter()
+    elif TRACING_EXPORTER in ('console', 'file'):
+        if TRACING_EXPORTER == 'file':
+            os.makedirs(os.path.dirname(TRACING_FILE) or '.', exist_ok=True)
+            out = open(TRACING_FILE, 'a')
+        else:
+            out = sys.stdout
+        exporter = sdk_export.ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        raise ValueError(f"Unknown TRACING_EXPORTER: {TRACING_EXPORTER}")
+    provider = sdk_trace.TracerProvider(resource=resource)
+    # Spans are exported in batches from a background thread
+    provider.add_span_processor(sdk_export.BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    atexit.register(provider.shutdown)
+    return trace.get_tracer('browser_service')
+
+tracer = setup_tracing()
+
+def span_trace_id(span: Optional["trace.Span"]) -> Optional[str]:
+    """Hex trace id of a span, None when tracing is off and no trace was propagated"""
+    span_context = span.get_span_context() if span is not None else None
+    return trace.format_trace_id(span_context.trace_id) if span_context and span_context.is_valid else None
+
 # Add LLM configuration
 LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'openai')
 LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4o') 
 LLM_TEMPERATURE = float(os.getenv('LLM_TEMPERATURE', '0.5'))
 
-def get_llm():
-    """Get LLM based on current configuration"""
-    if LLM_PROVIDER == 'bedrock':
+# Prometheus metrics, served at /metrics. Gauges are refreshed on each scrape.
+SESSION_CREATE_SECONDS = Histogram(
+    'browser_agent_session_create_seconds', 'Time to create a session and get its browser')
+COMMAND_QUEUE_WAIT_SECONDS = Histogram(
+    'browser_agent_command_queue_wait_seconds', 'Time commands spend queued in their session',
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+AGENT_RUN_SECONDS = Histogram(
+    'browser_agent_agent_run_seconds', 'Duration of browser_use agent runs',
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+LLM_CALL_SECONDS = Histogram(
+    'browser_agent_llm_call_seconds', 'Latency of each LLM call (one per agent step)', ['llm'],
+    buckets=(0.25, 0.5, 1, 2, 4, 8, 15, 30, 60))
+LLM_RATE_LIMIT_WAIT_SECONDS = Histogram(
+    'browser_agent_llm_rate_limit_wait_seconds', 'Time LLM calls wait for rate limit budget', ['llm'])
+LLM_TTFT_SECONDS = Histogram(
+    'browser_agent_llm_ttft_seconds', 'Time to the first streamed token', ['llm'],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30))
+LLM_OUTPUT_TOKENS_PER_SECOND = Histogram(
+    'browser_agent_llm_output_tokens_per_second', 'Streamed output tokens per second after the first token', ['llm'],
+    buckets=(5, 10, 25, 50, 100, 200, 400))
+EARLY_ACTION_HEAD_START_SECONDS = Histogram(
+    'browser_agent_early_action_head_start_seconds', 'How long before the end of the LLM stream an action was dispatched')
+LLM_TOKENS = Histogram(
+    'browser_agent_llm_tokens', 'Tokens per LLM call', ['llm', 'kind'],
+    buckets=(100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000))
+COMMANDS_TOTAL = Counter('browser_agent_commands_total', 'Finished commands', ['type', 'status'])
+ERRORS_TOTAL = Counter('browser_agent_errors_total', 'Errors by source and type', ['source', 'type'])
+LLM_HEDGES_TOTAL = Counter('browser_agent_llm_hedges_total', 'Hedged LLM calls, hedge wins and failovers', ['outcome'])
+LLM_THROTTLES_TOTAL = Counter('browser_agent_llm_throttles_total', 'Throttling responses from LLM providers', ['llm'])
+SESSIONS_GAUGE = Gauge('browser_agent_sessions', 'Live sessions')
+BROWSERS_GAUGE = Gauge('browser_agent_browsers', 'Pooled browsers', ['state'])
+QUEUE_DEPTH_GAUGE = Gauge('browser_agent_queue_depth', 'Commands queued across all sessions')
+AGENTS_RUNNING_GAUGE = Gauge('browser_agent_agents_running', 'Agents holding a scheduler slot')
+LLM_IN_FLIGHT_GAUGE = Gauge('browser_agent_llm_in_flight', 'LLM calls in flight')
+CHROME_RSS_GAUGE = Gauge('browser_agent_chrome_rss_bytes', 'Resident memory of the Playwright and Chrome processes')
+
+# Global scheduler configuration
+MAX_CONCURRENT_AGENTS = int(os.getenv('MAX_CONCURRENT_AGENTS', '4'))
+MAX_CONCURRENT_LLM_CALLS = int(os.getenv('MAX_CONCURRENT_LLM_CALLS', '8'))
+SCHEDULER_MAX_BACKLOG = int(os.getenv('SCHEDULER_MAX_BACKLOG', '100'))
+SCHEDULER_PRIORITY_ENABLED = os.getenv('SCHEDULER_PRIORITY_ENABLED', 'False').lower() == 'true'
+
+class SchedulerBacklogFull(Exception):
+    """Raised when too many commands are already waiting to run"""
+
+    def __init__(self, backlog: int, retry_after: int):
+        super().__init__(f"Command backlog is full ({backlog} queued), retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class AgentScheduler:
+    """Global admission control for agents and LLM calls across all sessions.
+
+    Agent slots are handed out in arrival order. Each session's worker waits for
+    at most one slot at a time and rejoins the back of the line after every
+    command, so sessions take turns round-robin. With priority enabled, higher
+    priority commands are served first and ties keep round-robin order.
+    """
+
+    def __init__(self, max_agents: int = MAX_CONCURRENT_AGENTS, max_llm_calls: int = MAX_CONCURRENT_LLM_CALLS,
+                 max_backlog: int = SCHEDULER_MAX_BACKLOG, priority_enabled: bool = SCHEDULER_PRIORITY_ENABLED):
+        self.max_agents = max(1, max_agents)
+        self.max_llm_calls = max(1, max_llm_calls)
+        self.max_backlog = max_backlog
+        self.priority_enabled = priority_enabled
+        self._running = 0
+        self._waiting: Dict[int, tuple] = {}
+        self._sequence = itertools.count()
+        self._llm_semaphore = asyncio.Semaphore(self.max_llm_calls)
+        self.llm_in_flight = 0
+        self.llm_calls = 0
+        self.llm_wait_total = 0.0
+        self.agents_started = 0
+        self.agent_wait_total = 0.0
+        self.agent_run_total = 0.0
+        self.agents_finished = 0
+        self.rejected = 0
+
+    def check_admission(self, backlog: int):
+        """Reject new work once the number of queued commands passes the threshold"""
+        if backlog < self.max_backlog:
+            return
+        self.rejected += 1
+        raise SchedulerBacklogFull(backlog, self.retry_after(backlog))
+
+    def retry_after(self, backlog: int) -> int:
+        """Rough number of seconds until the backlog has room again"""
+        avg_run = self.agent_run_total / self.agents_finished if self.agents_finished else 30.0
+        excess = backlog - self.max_backlog + 1
+        return max(1, math.ceil(excess * avg_run / self.max_agents))
+
+    @asynccontextmanager
+    async def agent_slot(self, priority: int = 0):
+        """Hold one of the global agent slots for the duration of a command"""
+        started = time.monotonic()
+        await self._acquire_agent(priority)
+        granted = time.monotonic()
+        self.agents_started += 1
+        self.agent_wait_total += granted - started
+        try:
+            yield
+        finally:
+            self.agent_run_total += time.monotonic() - granted
+            self.agents_finished += 1
+            self._running -= 1
+            self._grant()
+
+    async def _acquire_agent(self, priority: int):
+        if self._running < self.max_agents and not self._waiting:
+            self._running += 1
+            return
+        key = next(self._sequence)
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[key] = (priority, future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            self._waiting.pop(key, None)
+            if future.done() and not future.cancelled():
+                # Slot was granted just as we were cancelled; pass it on
+                self._running -= 1
+                self._grant()
+            raise
+
+    def _grant(self):
+        while self._running < self.max_agents and self._waiting:
+            if self.priority_enabled:
+                key = min(self._waiting, key=lambda k: (-self._waiting[k][0], k))
+            else:
+                key = next(iter(self._waiting))
+            _, future = self._waiting.pop(key)
+            if future.done():
+                continue
+            self._running += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def llm_slot(self):
+        """Hold one of the global in-flight LLM call slots"""
+        started = time.monotonic()
+        async with self._llm_semaphore:
+            self.llm_wait_total += time.monotonic() - started
+            self.llm_calls += 1
+            self.llm_in_flight += 1
+            try:
+                yield
+            finally:
+                self.llm_in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Running and waiting agents, in-flight LLM calls and wait times"""
+        return {
+            "max_agents": self.max_agents,
+            "max_llm_calls": self.max_llm_calls,
+            "max_backlog": self.max_backlog,
+            "priority_enabled": self.priority_enabled,
+            "agents_running": self._running,
+            "agents_waiting": len(self._waiting),
+            "agents_started": self.agents_started,
+            "agent_wait_avg": self.agent_wait_total / self.agents_started if self.agents_started else 0.0,
+            "agent_run_avg": self.agent_run_total / self.agents_finished if self.agents_finished else 0.0,
+            "llm_in_flight": self.llm_in_flight,
+            "llm_calls": self.llm_calls,
+            "llm_wait_avg": self.llm_wait_total / self.llm_calls if self.llm_calls else 0.0,
+            "rejected": self.rejected,
+        }
+
+scheduler = AgentScheduler()
+
+# Provider rate limits. LLM_RATE_LIMITS overrides the defaults per model, e.g.
+# {"gpt-4o": {"rpm": 500, "tpm": 30000}}; 0 leaves a budget unlimited
+LLM_RATE_LIMIT_RPM = float(os.getenv('LLM_RATE_LIMIT_RPM', '0'))
+LLM_RATE_LIMIT_TPM = float(os.getenv('LLM_RATE_LIMIT_TPM', '0'))
+LLM_RATE_LIMITS: Dict[str, Dict[str, float]] = json.loads(os.getenv('LLM_RATE_LIMITS', '{}'))
+LLM_THROTTLE_MAX_RETRIES = int(os.getenv('LLM_THROTTLE_MAX_RETRIES', '3'))
+LLM_THROTTLE_BACKOFF = float(os.getenv('LLM_THROTTLE_BACKOFF', '1'))
+LLM_THROTTLE_MAX_BACKOFF = float(os.getenv('LLM_THROTTLE_MAX_BACKOFF', '60'))
+
+def is_throttling_error(error: Exception) -> bool:
+    """Whether a provider error means we are being rate limited"""
+    if getattr(error, 'status_code', None) == 429:
+        return True
+    # botocore's ClientError carries the parsed error response as a dict
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code') in ('ThrottlingException', 'TooManyRequestsException')
+    return False
+
+# Errors that say nothing about the request itself, so another model may well succeed
+TRANSIENT_ERROR_TYPES = {
+    'TimeoutError', 'ConnectionError',  # asyncio and socket errors
+    'APITimeoutError', 'APIConnectionError',  # openai
+    'TimeoutException', 'NetworkError',  # httpx
+    'ReadTimeoutError', 'ConnectTimeoutError', 'EndpointConnectionError', 'ConnectionClosedError',  # botocore
+}
+TRANSIENT_ERROR_CODES = {'ServiceUnavailableException', 'InternalServerException', 'ModelTimeoutException',
+                         'ModelNotReadyException'}
+
+def is_transient_error(error: Exception) -> bool:
+    """Whether a provider error is throttling, a timeout, a connection failure or a 5xx"""
+    if is_throttling_error(error):
+        return True
+    if any(cls.__name__ in TRANSIENT_ERROR_TYPES for cls in type(error).__mro__):
+        return True
+    status = getattr(error, 'status_code', None)
+    if isinstance(status, int) and status >= 500:
+        return True
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return (response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES
+                or response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500)
+    return False
+
+def throttle_retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait, from a Retry-After header"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+class TokenBucket:
+    """Budget refilled continuously at `per_minute` units a minute, bursting up to one minute's worth"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self.scale = 1.0
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.per_minute, self.tokens + (now - self._updated) * self.per_minute * self.scale / 60)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` is available; 0 when unlimited"""
+        if self.per_minute <= 0:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.per_minute)
+        return max(0.0, (amount - self.tokens) * 60 / (self.per_minute * self.scale))
+
+    def take(self, amount: float):
+        if self.per_minute > 0:
+            self._refill()
+            self.tokens -= amount
+
+class ModelRateLimiter:
+    """Request and token budgets for one provider model, served in arrival order.
+
+    Throttling responses halve the refill rate and pause all callers with
+    exponential backoff; each successful call wins back a little of the rate.
+    """
+
+    MIN_SCALE = 0.1
+
+    def __init__(self, llm_type: str, rpm: float, tpm: float):
+        self.llm_type = llm_type
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._lock = asyncio.Lock()
+        self.scale = 1.0
+        self.backoff_until = 0.0
+        self._consecutive_throttles = 0
+        self.output_tokens_avg = 500.0
+        self.waiting = 0
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _set_scale(self, scale: float):
+        self.scale = min(1.0, max(self.MIN_SCALE, scale))
+        self.requests.scale = self.tokens.scale = self.scale
+
+    async def acquire(self, input_tokens: int) -> float:
+        """Wait for budget for one call; returns the tokens reserved for it"""
+        estimate = input_tokens + self.output_tokens_avg
+        started = time.monotonic()
+        self.waiting += 1
+        try:
+            # asyncio.Lock wakes waiters first come, first served
+            async with self._lock:
+                while True:
+                    delay = max(self.backoff_until - time.monotonic(), self.requests.wait_time(1), self.tokens.wait_time(estimate))
+                    if delay <= 0:
+                        break
+                    await asyncio.sleep(delay)
+                self.requests.take(1)
+                self.tokens.take(estimate)
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.calls += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        LLM_RATE_LIMIT_WAIT_SECONDS.labels(self.llm_type).observe(waited)
+        return estimate
+
+    def succeeded(self, reserved: float, usage: Optional[Dict[str, Any]]):
+        """Charge the tokens actually used and recover some of the rate"""
+        self._consecutive_throttles = 0
+        self._set_scale(self.scale + 0.05)
+        if usage:
+            self.tokens.take(usage.get('total_tokens', 0) - reserved)
+            self.output_tokens_avg = 0.9 * self.output_tokens_avg + 0.1 * usage.get('output_tokens', 0)
+
+    def throttled(self, error: Exception) -> float:
+        """Slow down after a throttling response; returns the backoff in seconds"""
+        self.throttles += 1
+        LLM_THROTTLES_TOTAL.labels(self.llm_type).inc()
+        self._consecutive_throttles += 1
+        self._set_scale(self.scale / 2)
+        backoff = throttle_retry_after(error)
+        if backoff is None:
+            backoff = min(LLM_THROTTLE_MAX_BACKOFF, LLM_THROTTLE_BACKOFF * 2 ** (self._consecutive_throttles - 1))
+            backoff *= random.uniform(0.5, 1.0)
+        self.backoff_until = max(self.backoff_until, time.monotonic() + backoff)
+        return backoff
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "rpm": self.requests.per_minute or None,
+            "tpm": self.tokens.per_minute or None,
+            "rate_scale": self.scale,
+            "backoff_remaining": max(0.0, self.backoff_until - time.monotonic()),
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "throttles": self.throttles,
+            "retries": self.retries,
+            "wait_avg": self.wait_total / self.calls if self.calls else 0.0,
+            "wait_max": self.wait_max,
+        }
+
+class LLMRateLimiter:
+    """Shared rate limiters for every provider model in use"""
+
+    def __init__(self, limits: Dict[str, Dict[str, float]] = LLM_RATE_LIMITS,
+                 default_rpm: float = LLM_RATE_LIMIT_RPM, default_tpm: float = LLM_RATE_LIMIT_TPM):
+        self.limits = limits
+        self.default_rpm = default_rpm
+        self.default_tpm = default_tpm
+        self._limiters: Dict[tuple, ModelRateLimiter] = {}
+
+    def limiter(self, llm_type: str, model: str) -> ModelRateLimiter:
+        key = (llm_type, model)
+        if key not in self._limiters:
+            # Bedrock model ids carry an inference profile prefix that config usually leaves out
+            limits = self.limits.get(model) or self.limits.get(model.removeprefix('us.')) or {}
+            self._limiters[key] = ModelRateLimiter(llm_type, limits.get('rpm', self.default_rpm), limits.get('tpm', self.default_tpm))
+        return self._limiters[key]
+
+    def stats(self) -> Dict[str, Any]:
+        """Budgets, queue wait and throttling per provider model"""
+        return {f"{llm_type}/{model}": limiter.stats() for (llm_type, model), limiter in self._limiters.items()}
+
+rate_limiter = LLMRateLimiter()
+
+# Streaming completions
+LLM_STREAMING = os.getenv('LLM_STREAMING', 'False').lower() == 'true'
+LLM_EARLY_DISPATCH = os.getenv('LLM_EARLY_DISPATCH', 'False').lower() == 'true'  # Needs LLM_STREAMING
+
+# Model that hedges and takes over for the current agent step's calls; routed steps use the agent's model
+llm_step_fallback: contextvars.ContextVar[Optional[Any]] = contextvars.ContextVar('llm_step_fallback', default=None)
+# Set while the hedger runs a call on the secondary, so that call isn't hedged again
+llm_hedging: contextvars.ContextVar[bool] = contextvars.ContextVar('llm_hedging', default=False)
+
+# Called with the message accumulated so far after every streamed chunk
+llm_stream_listener: contextvars.ContextVar[Optional[Any]] = contextvars.ContextVar('llm_stream_listener', default=None)
+
+# Prompt caching for the stable prefix of agent conversations
+LLM_PROMPT_CACHE_ENABLED = os.getenv('LLM_PROMPT_CACHE_ENABLED', 'True').lower() == 'true'
+# browser_use ends every agent's fixed preamble (system prompt, task, example output) with this message
+PROMPT_PREFIX_END = '[Your task history memory starts here]'
+
+# Token usage of the LLM calls made for the running command
+command_llm_usage: contextvars.ContextVar[Optional[Dict[str, int]]] = contextvars.ContextVar('command_llm_usage', default=None)
+
+def new_llm_usage() -> Dict[str, int]:
+    return {"calls": 0, "input_tokens": 0, "output_tokens": 0, "cache_read_tokens": 0, "cache_write_tokens": 0}
+
+def mark_prompt_cache(messages):
+    """Copy of the messages with a cache breakpoint after the agent's preamble
+
+    Anthropic caches everything up to the breakpoint, so tools, system prompt
+    and task text are read from cache on every step after the first.
+    """
+    for i, message in enumerate(messages):
+        if message.type == 'human' and message.content == PROMPT_PREFIX_END:
+            marked = message.model_copy(update={"content": [
+                {"type": "text", "text": message.content, "cache_control": {"type": "ephemeral"}}
+            ]})
+            return [*messages[:i], marked, *messages[i + 1:]]
+    return messages
+
+def llm_model_name(llm) -> str:
+    """The model a chat model calls, whichever attribute its provider keeps it in"""
+    return getattr(llm, 'model_name', None) or getattr(llm, 'model_id', None) or getattr(llm, 'model', '')
+
+def estimate_input_tokens(messages) -> int:
+    """Rough prompt size in tokens, before the provider reports usage"""
+    return sum(len(str(message.content)) for message in messages) // 4
+
+class ManagedChatModel:
+    """Mixin routing a LangChain chat model's async calls through the scheduler"""
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        if not llm_hedging.get():
+            fallback = llm_step_fallback.get()
+            if fallback is not None and fallback is not self:
+                return await routed_llm_hedger.generate(self, fallback, messages, stop, run_manager, kwargs)
+            secondary = get_secondary_llm() if self is get_llm() else None
+            if secondary is not None and secondary is not self:
+                return await llm_hedger.generate(self, secondary, messages, stop, run_manager, kwargs)
+        return await self._generate_managed(messages, stop, run_manager, **kwargs)
+
+    async def _generate_managed(self, messages, stop=None, run_manager=None, **kwargs):
+        model = llm_model_name(self)
+        limiter = rate_limiter.limiter(self._llm_type, model)
+        # OpenAI caches long prefixes on its own; Bedrock Anthropic models need an explicit breakpoint
+        if LLM_PROMPT_CACHE_ENABLED and self._llm_type == 'amazon_bedrock_chat' and 'anthropic' in model:
+            messages = mark_prompt_cache(messages)
+        input_tokens = estimate_input_tokens(messages)
+        with tracer.start_as_current_span("llm.call", attributes={"llm.type": self._llm_type}) as span:
+            # Throttling and other transient errors (5xx, timeouts, dropped connections) are
+            # retried here, behind the shared limiter, not by each client
+            for attempt in range(LLM_THROTTLE_MAX_RETRIES + 1):
+                reserved = await limiter.acquire(input_tokens)
+                retry_delay = 0.0
+                async with scheduler.llm_slot():
+                    started = time.monotonic()
+                    try:
+                        if LLM_STREAMING:
+                            result = await self._agenerate_streamed(messages, stop, run_manager, span, **kwargs)
+                        else:
+                            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                        break
+                    except Exception as e:
+                        throttled = is_throttling_error(e)
+                        transient = throttled or is_transient_error(e)
+                        if throttled:
+                            # The limiter holds every caller of this model back for the backoff
+                            backoff = limiter.throttled(e)
+                            logger.warning("LLM call throttled", extra={"llm": self._llm_type, "model": model,
+                                                                        "attempt": attempt + 1, "backoff": backoff})
+                        elif transient:
+                            # Only this call backs off; the provider isn't asking everyone to slow down
+                            retry_delay = min(LLM_THROTTLE_MAX_BACKOFF, LLM_THROTTLE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+                            logger.warning("LLM call failed, retrying", extra={"llm": self._llm_type, "model": model,
+                                                                               "attempt": attempt + 1, "backoff": retry_delay,
+                                                                               "error": str(e)})
+                        if not transient or attempt == LLM_THROTTLE_MAX_RETRIES:
+                            ERRORS_TOTAL.labels('llm', type(e).__name__).inc()
+                            raise
+                        limiter.retries += 1
+                # Back off outside the LLM slot so other calls can use it meanwhile
+                await asyncio.sleep(retry_delay)
+            LLM_CALL_SECONDS.labels(self._llm_type).observe(time.monotonic() - started)
+            usage = result.generations[0].message.usage_metadata if result.generations else None
+            limiter.succeeded(reserved, usage)
+            if usage:
+                details = usage.get('input_token_details') or {}
+                tokens = {
+                    "input_tokens": usage.get('input_tokens', 0),
+                    "output_tokens": usage.get('output_tokens', 0),
+                    "cache_read_tokens": details.get('cache_read') or 0,
+                    "cache_write_tokens": details.get('cache_creation') or 0,
+                }
+                LLM_TOKENS.labels(self._llm_type, 'input').observe(tokens["input_tokens"])
+                LLM_TOKENS.labels(self._llm_type, 'output').observe(tokens["output_tokens"])
+                LLM_TOKENS.labels(self._llm_type, 'cache_read').observe(tokens["cache_read_tokens"])
+                LLM_TOKENS.labels(self._llm_type, 'cache_write').observe(tokens["cache_write_tokens"])
+                for key, value in tokens.items():
+                    span.set_attribute(f"llm.{key}", value)
+                command_usage = command_llm_usage.get()
+                if command_usage is not None:
+                    command_usage["calls"] += 1
+                    for key, value in tokens.items():
+                        command_usage[key] += value
+            return result
+
+    async def _agenerate_streamed(self, messages, stop, run_manager, span, **kwargs):
+        """Build the completion from the provider's stream, timing the first token"""
+        started = time.monotonic()
+        first_token = None
+        message = None
+        listener = llm_stream_listener.get()
+        async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            if first_token is None and (chunk.message.content or chunk.message.tool_call_chunks):
+                first_token = time.monotonic() - started
+                LLM_TTFT_SECONDS.labels(self._llm_type).observe(first_token)
+                span.set_attribute("llm.ttft", first_token)
+            message = chunk.message if message is None else message + chunk.message
+            if listener is not None:
+                listener(message)
+        if message is None:
+            raise ValueError("LLM stream ended without a response")
+
+        output_tokens = (message.usage_metadata or {}).get('output_tokens', 0)
+        generating = time.monotonic() - started - (first_token or 0)
+        if output_tokens and generating > 0:
+            LLM_OUTPUT_TOKENS_PER_SECOND.labels(self._llm_type).observe(output_tokens / generating)
+        outputs = lazy_import('langchain_core.outputs')
+        message_chunk_to_message = lazy_import('langchain_core.messages').message_chunk_to_message
+        return outputs.ChatResult(generations=[outputs.ChatGeneration(message=message_chunk_to_message(message))])
+
+_managed_llm_classes: Dict[type, type] = {}
+
+def managed_llm_class(cls: type) -> type:
+    """Get the scheduler-managed subclass of a chat model class"""
+    if cls not in _managed_llm_classes:
+        # Keep the original class name: browser_use picks its tool calling method from it
+        _managed_llm_classes[cls] = type(cls.__name__, (ManagedChatModel, cls), {"__module__": cls.__module__})
+    return _managed_llm_classes[cls]
+
+# Connection pooling for LLM provider clients
+LLM_HTTP_MAX_CONNECTIONS = int(os.getenv('LLM_HTTP_MAX_CONNECTIONS', str(max(10, MAX_CONCURRENT_LLM_CALLS))))
+LLM_HTTP_KEEPALIVE_EXPIRY = float(os.getenv('LLM_HTTP_KEEPALIVE_EXPIRY', '60'))
+
+def create_llm(provider: str, model: str, temperature: float):
+    """Build a chat model with a keep-alive connection pool"""
+    if provider == 'bedrock':
+        ChatBedrock = lazy_import('langchain_aws').ChatBedrock
+        boto3 = lazy_import('boto3')
+        BotoConfig = lazy_import('botocore.config').Config
         # Ensure model ID has "us." prefix for Bedrock models (x-region inference profiles in AWS bedrock)
-        model_id = LLM_MODEL if LLM_MODEL.startswith("us.") else f"us.{LLM_MODEL}"
+        model_id = model if model.startswith("us.") else f"us.{model}"
         
-        return ChatBedrock(
+        return managed_llm_class(ChatBedrock)(
             model_id=model_id,
             region_name="us-east-1",
-            model_kwargs={"temperature": LLM_TEMPERATURE},
-            client=boto3.client("bedrock-runtime", region_name="us-east-1")
+            model_kwargs={"temperature": temperature},
+            client=boto3.client(
+                "bedrock-runtime",
+                region_name="us-east-1",
+                # Throttling retries are left to the shared rate limiter
+                config=BotoConfig(max_pool_connections=LLM_HTTP_MAX_CONNECTIONS, tcp_keepalive=True,
+                                  retries={"mode": "standard", "total_max_attempts": 1})
+            )
+        )
+    elif provider == 'openai':
+        ChatOpenAI = lazy_import('langchain_openai').ChatOpenAI
+        httpx = lazy_import('httpx')
+        limits = httpx.Limits(
+            max_connections=LLM_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_HTTP_MAX_CONNECTIONS,
+            keepalive_expiry=LLM_HTTP_KEEPALIVE_EXPIRY
         )
-    elif LLM_PROVIDER == 'openai':
-        return ChatOpenAI(
-            model=LLM_MODEL,
-            temperature=LLM_TEMPERATURE
+        return managed_llm_class(ChatOpenAI)(
+            model=model,
+            temperature=temperature,
+            max_retries=0,  # Throttling retries are left to the shared rate limiter
+            stream_usage=True,
+            http_client=httpx.Client(limits=limits),
+            http_async_client=httpx.AsyncClient(limits=limits)
         )
-    elif LLM_PROVIDER == 'ollama':
-        return ChatOllama(
-            model=LLM_MODEL,
-            temperature=LLM_TEMPERATURE
+    elif provider == 'ollama':
+        ChatOllama = lazy_import('langchain_ollama').ChatOllama
+        return managed_llm_class(ChatOllama)(
+            model=model,
+            temperature=temperature
         )
     else:
-        raise ValueError(f"Unsupported LLM provider: {LLM_PROVIDER}")
+        raise ValueError(f"Unsupported LLM provider: {provider}")
+
+# Chat models are stateless between calls, so one instance per
+# (provider, model, temperature) is shared by every agent in the process
+_llm_cache: Dict[tuple, Any] = {}
+
+def cached_llm(provider: str, model: str):
+    """Get the shared chat model for a provider and model"""
+    key = (provider, model, LLM_TEMPERATURE)
+    llm = _llm_cache.get(key)
+    if llm is None:
+        llm = _llm_cache[key] = create_llm(*key)
+    return llm
+
+def get_llm():
+    """Get LLM based on current configuration"""
+    return cached_llm(LLM_PROVIDER, LLM_MODEL)
+
+def clear_llm_cache():
+    """Drop cached chat models so the next get_llm() builds fresh clients.
+
+    For tests and the benchmark only: the dropped models' connection pools are
+    not closed, and running agents may still hold them.
+    """
+    _llm_cache.clear()
+
+# Hedging and failover to a secondary model
+LLM_SECONDARY_PROVIDER = os.getenv('LLM_SECONDARY_PROVIDER', '')  # Defaults to LLM_PROVIDER
+LLM_SECONDARY_MODEL = os.getenv('LLM_SECONDARY_MODEL', '')  # Empty disables hedging and failover
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'False').lower() == 'true'
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '95'))
+LLM_HEDGE_INITIAL_DELAY = float(os.getenv('LLM_HEDGE_INITIAL_DELAY', '10'))
+LLM_HEDGE_MAX_RATE = float(os.getenv('LLM_HEDGE_MAX_RATE', '0.1'))
+LLM_HEDGE_MAX_TPM = float(os.getenv('LLM_HEDGE_MAX_TPM', '0'))  # 0 leaves hedge spend uncapped by tokens
+
+def get_secondary_llm():
+    """Chat model used for hedged requests and failover, None when not configured"""
+    if not LLM_SECONDARY_MODEL:
+        return None
+    return cached_llm(LLM_SECONDARY_PROVIDER or LLM_PROVIDER, LLM_SECONDARY_MODEL)
+
+class LLMHedger:
+    """Sends a slow primary LLM call to the secondary model too and takes the
+    first answer; fails over to the secondary when the primary errors.
+
+    The hedge delay is a percentile of recent primary latencies. Hedges are
+    capped to a fraction of calls and to a token budget, since each one pays
+    for the prompt twice.
+    """
+
+    MIN_SAMPLES = 20
+
+    def __init__(self, enabled: bool = LLM_HEDGE_ENABLED, percentile: float = LLM_HEDGE_PERCENTILE,
+                 initial_delay: float = LLM_HEDGE_INITIAL_DELAY, max_rate: float = LLM_HEDGE_MAX_RATE,
+                 max_tpm: float = LLM_HEDGE_MAX_TPM, secondary: Optional[str] = None):
+        self.secondary = secondary  # Shown in stats; defaults to the configured secondary model
+        self.enabled = enabled
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.max_rate = max_rate
+        self.budget = TokenBucket(max_tpm)
+        self._latencies: deque = deque(maxlen=200)
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedges_skipped = 0
+        self.failovers = 0
+        self.extra_tokens = 0
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait on the primary before hedging"""
+        if len(self._latencies) < self.MIN_SAMPLES:
+            return self.initial_delay
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+
+    def _may_hedge(self, input_tokens: int) -> bool:
+        if self.hedges >= self.max_rate * self.calls or self.budget.wait_time(input_tokens) > 0:
+            self.hedges_skipped += 1
+            return False
+        return True
+
+    async def generate(self, primary, secondary, messages, stop, run_manager, kwargs):
+        self.calls += 1
+        # Either racing stream may lose, so neither may dispatch actions early
+        llm_stream_listener.set(None)
+        started = time.monotonic()
+        primary_task = asyncio.create_task(primary._generate_managed(messages, stop, run_manager, **kwargs))
+        tasks = {primary_task}
+        hedged = False
+        try:
+            if self.enabled:
+                await asyncio.wait(tasks, timeout=self.hedge_delay())
+                input_tokens = estimate_input_tokens(messages)
+                if not primary_task.done() and self._may_hedge(input_tokens):
+                    logger.info("Hedging slow LLM call", extra={"waited": time.monotonic() - started})
+                    self.hedges += 1
+                    hedged = True
+                    # The prompt is paid for twice whichever call wins
+                    self.budget.take(input_tokens)
+                    self.extra_tokens += input_tokens
+                    LLM_HEDGES_TOTAL.labels('hedged').inc()
+                    tasks.add(asyncio.create_task(self._generate_secondary(secondary, messages, stop, kwargs)))
+
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        # A hedge win means the primary took at least this long
+                        self._latencies.append(time.monotonic() - started)
+                        if task is not primary_task:
+                            self.hedge_wins += 1
+                            LLM_HEDGES_TOTAL.labels('hedge_won').inc()
+                        return task.result()
+            error = primary_task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # The primary failed; try the secondary unless it already had its chance or the
+        # request itself is at fault (bad schema, context length, auth), which would fail again
+        if hedged or not is_transient_error(error):
+            raise error
+        self.failovers += 1
+        LLM_HEDGES_TOTAL.labels('failover').inc()
+        logger.warning("Primary LLM call failed, failing over", extra={"error": str(error)})
+        return await self._generate_secondary(secondary, messages, stop, kwargs)
+
+    @staticmethod
+    async def _generate_secondary(secondary, messages, stop, kwargs):
+        """Run the primary's request on the secondary, rebinding its tools in the secondary's format"""
+        ChatGeneration = lazy_import('langchain_core.outputs').ChatGeneration
+        ChatResult = lazy_import('langchain_core.outputs').ChatResult
+        runnable = secondary
+        if kwargs.get('tools'):
+            tools = [
+                # Anthropic-style schemas from Bedrock; bind_tools accepts OpenAI-style everywhere
+                {"type": "function", "function": {"name": tool["name"], "description": tool.get("description", ""),
+                                                  "parameters": tool["input_schema"]}}
+                if "input_schema" in tool else tool
+                for tool in kwargs['tools']
+            ]
+            tool_choice = kwargs.get('tool_choice')
+            if isinstance(tool_choice, dict):
+                tool_choice = tool_choice.get('function', {}).get('name') or tool_choice.get('name')
+            runnable = secondary.bind_tools(tools, tool_choice=tool_choice)
+        hedging_token = llm_hedging.set(True)
+        try:
+            message = await runnable.ainvoke(messages, stop=stop)
+        finally:
+            llm_hedging.reset(hedging_token)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def stats(self) -> Dict[str, Any]:
+        """Hedge and failover counts, the current hedge delay and extra token spend"""
+        return {
+            "enabled": self.enabled,
+            "secondary": self.secondary or (f"{LLM_SECONDARY_PROVIDER or LLM_PROVIDER}/{LLM_SECONDARY_MODEL}" if LLM_SECONDARY_MODEL else None),
+            "hedge_delay": self.hedge_delay(),
+            "latency_samples": len(self._latencies),
+            "calls": self.calls,
+            "hedges": self.hedges,
+            "hedge_rate": self.hedges / self.calls if self.calls else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "hedges_skipped": self.hedges_skipped,
+            "failovers": self.failovers,
+            "extra_tokens": self.extra_tokens,
+        }
+
+llm_hedger = LLMHedger()
+# Steps routed to the fast model hedge and fail over to the agent's own model
+routed_llm_hedger = LLMHedger(secondary="agent model")
+
+# Per-step model routing
+LLM_FAST_PROVIDER = os.getenv('LLM_FAST_PROVIDER', '')  # Defaults to LLM_PROVIDER
+LLM_FAST_MODEL = os.getenv('LLM_FAST_MODEL', '')  # Empty runs every step on LLM_MODEL
+LLM_ROUTING_MAX_ELEMENTS = int(os.getenv('LLM_ROUTING_MAX_ELEMENTS', '150'))
+
+class StepRouter:
+    """Picks the model for each agent step.
+
+    Planning (the first step), steps after a failure and pages with many
+    interactive elements go to the agent's model; routine steps go to
+    LLM_FAST_MODEL.
+    """
+
+    def __init__(self, max_elements: int = LLM_ROUTING_MAX_ELEMENTS):
+        self.max_elements = max_elements
+        self._models: Dict[str, Dict[str, Any]] = {}
+        self._reasons: Dict[str, int] = {}
+
+    def choose(self, agent) -> tuple:
+        """(chat model, reason) for the agent's next step"""
+        if not LLM_FAST_MODEL:
+            return agent.llm, "default"
+        state = getattr(agent.browser_context, 'current_state', None)
+        elements = len(state.selector_map) if state is not None else 0
+        if agent.n_steps <= 1:
+            reason = "plan"
+        elif agent.consecutive_failures or any(result.error for result in agent._last_result or []):
+            reason = "escalate"
+        elif elements > self.max_elements:
+            reason = "large_dom"
+        else:
+            return cached_llm(LLM_FAST_PROVIDER or LLM_PROVIDER, LLM_FAST_MODEL), "routine"
+        return agent.llm, reason
+
+    def record(self, model: str, reason: str, seconds: float, failed: bool):
+        stats = self._models.setdefault(model, {"steps": 0, "failures": 0, "seconds": 0.0})
+        stats["steps"] += 1
+        stats["failures"] += int(failed)
+        stats["seconds"] += seconds
+        self._reasons[reason] = self._reasons.get(reason, 0) + 1
+
+    def stats(self) -> Dict[str, Any]:
+        """Steps, failures and average LLM latency per model, and how often each rule fired"""
+        return {
+            "fast_model": LLM_FAST_MODEL or None,
+            "max_elements": self.max_elements,
+            "models": {
+                model: {
+                    "steps": stats["steps"],
+                    "failures": stats["failures"],
+                    "latency_avg": stats["seconds"] / stats["steps"],
+                }
+                for model, stats in self._models.items()
+            },
+            "reasons": dict(self._reasons),
+        }
+
+step_router = StepRouter()
 
 # Check if running in Docker by looking for container environment
+@functools.lru_cache(maxsize=None)
 def is_running_in_docker():
     try:
         with open('/proc/self/cgroup', 'r') as f:
@@ -86,30 +1008,6 @@ def is_running_in_docker():
     except:
         return False
 
-# Determine if we should use CDP to connect to host Chrome
-in_docker = is_running_in_docker()
-
-if in_docker:
-    # When in Docker, use CDP to connect to Chrome on the host
-    cdp_url = "ws://host.docker.internal:9222"
-    chrome_instance_path = None  # Not needed when using CDP
-else:
-    # When running directly on the host
-    cdp_url = None
-    if platform.system() == "Darwin":  # macOS
-        chrome_instance_path = '/Applications/Google Chrome.app/Contents/MacOS/Google Chrome'
-    else:  # Linux/Unix
-        chrome_instance_path = '/usr/bin/chromium'
-    
-    # Check if the path exists, use alternative if not
-    if not os.path.exists(chrome_instance_path):
-        if platform.system() == "Darwin":
-            # Fallback for macOS
-            chrome_instance_path = '/Applications/Chromium.app/Contents/MacOS/Chromium'
-        else:
-            # Fallback for Linux/Unix
-            chrome_instance_path = '/usr/bin/google-chrome'
-
 def get_chrome_path():
     """Get the Chrome executable path based on the platform"""
     if platform.system() == "Darwin":  # macOS
@@ -132,18 +1030,20 @@ def get_chrome_path():
 
 def get_browser():
     """Get a browser instance based on the configured connection mode"""
-    print(f"\n=== Browser Configuration ===")
-    print(f"Connection Mode: {CONNECTION_MODE}")
-    print(f"Chrome Host: {CHROME_HOST}")
-    print(f"Chrome Port: {CHROME_PORT}")
-    print(f"Chrome CDP URL: {CHROME_CDP_URL}")
-    print(f"Headless Mode: {HEADLESS}")
-    print(f"Debug Mode: {DEBUG}")
-    print(f"Running in Docker: {is_running_in_docker()}")
-    
+    logger.debug("Browser configuration", extra={
+        "connection_mode": CONNECTION_MODE,
+        "chrome_host": CHROME_HOST,
+        "chrome_port": CHROME_PORT,
+        "chrome_cdp_url": CHROME_CDP_URL,
+        "headless": HEADLESS,
+        "in_docker": is_running_in_docker(),
+    })
+
+    browser_use = lazy_import('browser_use')
+    Browser, BrowserConfig = browser_use.Browser, browser_use.BrowserConfig
     try:
         if CONNECTION_MODE == 'cdp':
-            print(f"Connecting to Chrome using CDP URL: {CHROME_CDP_URL}")
+            logger.info("Connecting to Chrome over CDP", extra={"cdp_url": CHROME_CDP_URL})
             chrome_path = None
             cdp_url = CHROME_CDP_URL
             
@@ -154,13 +1054,13 @@ def get_browser():
             )
             
         elif CONNECTION_MODE == 'application':
-            print("Starting Chrome as an application")
+            logger.info("Starting Chrome as an application")
             chrome_path = get_chrome_path()
             cdp_url = None
             launch_args = []
             
             if HEADLESS:
-                print("Using headless mode")
+                logger.debug("Using headless mode")
                 launch_args.append('--headless=new')  # Modern headless mode
                 
             browser = Browser(
@@ -173,22 +1073,917 @@ def get_browser():
         else:
             raise ValueError(f"Invalid CONNECTION_MODE: {CONNECTION_MODE}")
         
-        print(f"\n=== Browser Instance Created ===")
-        print(f"Chrome Path: {chrome_path or 'Not used'}")
-        print(f"CDP URL: {cdp_url or 'Not used'}")
-        print(f"=== End Browser Configuration ===\n")
-        
+        logger.debug("Browser instance created", extra={"chrome_path": chrome_path, "cdp_url": cdp_url})
+
         return browser
             
     except Exception as e:
-        print(f"Error initializing browser: {e}")
+        logger.error("Error initializing browser", extra={"error": str(e)})
         raise
 
+# Browser pool configuration
+BROWSER_POOL_MIN_SIZE = int(os.getenv('BROWSER_POOL_MIN_SIZE', '1'))
+BROWSER_POOL_MAX_SIZE = int(os.getenv('BROWSER_POOL_MAX_SIZE', '10'))
+BROWSER_POOL_ACQUIRE_TIMEOUT = float(os.getenv('BROWSER_POOL_ACQUIRE_TIMEOUT', '30'))
+BROWSER_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('BROWSER_POOL_HEALTH_CHECK_INTERVAL', '30'))
+BROWSER_PROBE_TIMEOUT = float(os.getenv('BROWSER_PROBE_TIMEOUT', '2'))
+
+class BrowserPoolExhausted(Exception):
+    """Raised when no pooled browser becomes available before the acquire timeout"""
+
+class BrowserPool:
+    """Pool of pre-launched, pre-connected browsers shared by sessions.
+
+    Sessions borrow a browser on create and hand it back on delete. The pool
+    keeps at least `min_size` idle browsers warm in the background, never owns
+    more than `max_size`, and drops browsers whose connection has died.
+    """
+
+    def __init__(self, min_size: int = BROWSER_POOL_MIN_SIZE, max_size: int = BROWSER_POOL_MAX_SIZE,
+                 acquire_timeout: float = BROWSER_POOL_ACQUIRE_TIMEOUT,
+                 health_check_interval: float = BROWSER_POOL_HEALTH_CHECK_INTERVAL):
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+        self._idle: deque = deque()
+        self._size = 0  # idle + leased + launching
+        self._generation = 0
+        self._browser_generation: Dict[int, int] = {}
+        self._available = asyncio.Condition()
+        self._refill_task: Optional[asyncio.Task] = None
+        self._health_task: Optional[asyncio.Task] = None
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.timeouts = 0
+        self.launch_failures = 0
+        self.recycled = 0
+        self.wait_count = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.last_wait_time = 0.0
+        self.crashes = 0
+        self.restarts = 0
+        self.probes = 0
+        self.probe_failures = 0
+        self.probe_time_total = 0.0
+        self.probe_time_max = 0.0
+        self.last_probe_time = 0.0
+
+    @staticmethod
+    def is_healthy(browser: "Browser") -> bool:
+        """Cheap liveness check on the underlying Playwright connection"""
+        playwright_browser = browser.playwright_browser
+        return playwright_browser is not None and playwright_browser.is_connected()
+
+    async def probe(self, browser: "Browser", timeout: float = BROWSER_PROBE_TIMEOUT) -> bool:
+        """Round-trip a CDP command to check the browser still answers"""
+        started = time.monotonic()
+        healthy = False
+        if self.is_healthy(browser):
+            async def ping():
+                cdp = await browser.playwright_browser.new_browser_cdp_session()
+                try:
+                    await cdp.send("Browser.getVersion")
+                finally:
+                    await cdp.detach()
+            try:
+                await asyncio.wait_for(ping(), timeout=timeout)
+                healthy = True
+            except Exception as e:
+                logger.warning("Browser probe failed", extra={"error": str(e) or type(e).__name__})
+                ERRORS_TOTAL.labels('browser', 'probe_failed').inc()
+        elapsed = time.monotonic() - started
+        self.probes += 1
+        self.probe_failures += 0 if healthy else 1
+        self.probe_time_total += elapsed
+        self.probe_time_max = max(self.probe_time_max, elapsed)
+        self.last_probe_time = elapsed
+        return healthy
+
+    def _watch(self, browser: "Browser"):
+        """Notice a browser dying as soon as Playwright reports the disconnect"""
+        def on_disconnected(_):
+            if id(browser) not in self._browser_generation:
+                return  # closed by us
+            self.crashes += 1
+            ERRORS_TOTAL.labels('browser', 'crash').inc()
+            logger.warning("Browser disconnected unexpectedly")
+            if browser in self._idle:
+                self._idle.remove(browser)
+                self._browser_generation.pop(id(browser), None)
+                self._size -= 1
+                self.recycled += 1
+                self._schedule_refill()
+        browser.playwright_browser.on("disconnected", on_disconnected)
+
+    async def start(self):
+        """Start background refill and health checking"""
+        self._closed = False
+        self._schedule_refill()
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_check_loop())
+
+    async def _launch(self) -> "Browser":
+        """Create a browser and connect to it so it is ready to use"""
+        browser = get_browser()
+        try:
+            await browser.get_playwright_browser()
+        except BaseException as e:
+            # Cancellation included: a half-launched browser must not be left running
+            if not isinstance(e, asyncio.CancelledError):
+                self.launch_failures += 1
+                ERRORS_TOTAL.labels('browser', 'launch_failed').inc()
+            await self._close_browser(browser)
+            raise
+        self._browser_generation[id(browser)] = self._generation
+        self._watch(browser)
+        return browser
+
+    async def _close_browser(self, browser: "Browser"):
+        self._browser_generation.pop(id(browser), None)
+        try:
+            await browser.close()
+        except Exception as e:
+            logger.warning("Error closing pooled browser", extra={"error": str(e)})
+
+    async def acquire(self) -> "Browser":
+        """Borrow a browser, launching one if the pool is empty and below max size"""
+        started = time.monotonic()
+        deadline = started + self.acquire_timeout
+        async with self._available:
+            while True:
+                while self._idle:
+                    browser = self._idle.popleft()
+                    if self.is_healthy(browser):
+                        self.hits += 1
+                        self._record_wait(started)
+                        self._schedule_refill()
+                        return browser
+                    self._size -= 1
+                    self.recycled += 1
+                    asyncio.create_task(self._close_browser(browser))
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise BrowserPoolExhausted(
+                        f"No browser available within {self.acquire_timeout}s (max pool size {self.max_size})"
+                    )
+                try:
+                    await asyncio.wait_for(self._available.wait(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+        # Pool miss: launch outside the lock so other borrowers aren't blocked
+        self.misses += 1
+        try:
+            browser = await self._launch()
+        except BaseException:
+            # Give the slot back on cancellation too, or cancelled launches shrink the pool for good
+            async with self._available:
+                self._size -= 1
+                self._available.notify()
+            raise
+        self._record_wait(started)
+        self._schedule_refill()
+        return browser
+
+    async def release(self, browser: Optional["Browser"], recycle: bool = False):
+        """Return a borrowed browser, closing it instead if it is stale or unhealthy"""
+        if browser is None:
+            return
+        stale = self._browser_generation.get(id(browser)) != self._generation
+        if recycle or stale or self._closed or not self.is_healthy(browser):
+            self.recycled += 1
+            await self._close_browser(browser)
+            async with self._available:
+                self._size -= 1
+                self._available.notify()
+            self._schedule_refill()
+            return
+        async with self._available:
+            self._idle.append(browser)
+            self._available.notify()
+
+    def _record_wait(self, started: float):
+        waited = time.monotonic() - started
+        self.wait_count += 1
+        self.wait_time_total += waited
+        self.wait_time_max = max(self.wait_time_max, waited)
+        self.last_wait_time = waited
+
+    def _schedule_refill(self):
+        if self._closed:
+            return
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        """Launch browsers in the background until min_size are idle"""
+        while not self._closed:
+            async with self._available:
+                if len(self._idle) >= self.min_size or self._size >= self.max_size:
+                    return
+                self._size += 1
+            try:
+                browser = await self._launch()
+            except Exception as e:
+                logger.warning("Error pre-launching pooled browser", extra={"error": str(e)})
+                async with self._available:
+                    self._size -= 1
+                return
+            async with self._available:
+                if self._closed:
+                    self._size -= 1
+                    asyncio.create_task(self._close_browser(browser))
+                    return
+                self._idle.append(browser)
+                self._available.notify()
+
+    async def _health_check_loop(self):
+        """Periodically drop idle browsers that have died and top the pool back up"""
+        while not self._closed:
+            await asyncio.sleep(self.health_check_interval)
+            idle = list(self._idle)
+            alive = await asyncio.gather(*(self.probe(browser) for browser in idle))
+            async with self._available:
+                # Skip browsers leased out while they were being probed
+                dead = [browser for browser, ok in zip(idle, alive) if not ok and browser in self._idle]
+                for browser in dead:
+                    self._idle.remove(browser)
+                    self._size -= 1
+                    self.recycled += 1
+            for browser in dead:
+                await self._close_browser(browser)
+            self._schedule_refill()
+
+    async def reset(self):
+        """Drop all idle browsers and retire leased ones on release, e.g. after a config change"""
+        self._generation += 1
+        async with self._available:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for browser in idle:
+            await self._close_browser(browser)
+        self._schedule_refill()
+
+    async def close(self):
+        """Stop background tasks and close all idle browsers"""
+        self._closed = True
+        for task in (self._refill_task, self._health_task):
+            if task and not task.done():
+                task.cancel()
+        async with self._available:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for browser in idle:
+            await self._close_browser(browser)
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool size, hit/miss counts and acquire wait times"""
+        return {
+            "min_size": self.min_size,
+            "max_size": self.max_size,
+            "size": self._size,
+            "idle": len(self._idle),
+            "leased": self._size - len(self._idle),
+            "hits": self.hits,
+            "misses": self.misses,
+            "timeouts": self.timeouts,
+            "launch_failures": self.launch_failures,
+            "recycled": self.recycled,
+            "wait_time_avg": self.wait_time_total / self.wait_count if self.wait_count else 0.0,
+            "wait_time_max": self.wait_time_max,
+            "wait_time_last": self.last_wait_time,
+            "crashes": self.crashes,
+            "restarts": self.restarts,
+            "probes": self.probes,
+            "probe_failures": self.probe_failures,
+            "probe_time_avg": self.probe_time_total / self.probes if self.probes else 0.0,
+            "probe_time_max": self.probe_time_max,
+            "probe_time_last": self.last_probe_time,
+        }
+
+browser_pool = BrowserPool()
+
+# Browser sharing: 'dedicated' gives every session its own browser, 'context'
+# packs sessions onto shared browsers with one isolated context each
+BROWSER_SHARING_MODE = os.getenv('BROWSER_SHARING_MODE', 'dedicated')  # Options: dedicated, context
+BROWSER_MAX_CONTEXTS_PER_BROWSER = int(os.getenv('BROWSER_MAX_CONTEXTS_PER_BROWSER', '10'))
+
+class _FreshContextsBrowser:
+    """Playwright browser view that hides existing contexts.
+
+    browser_use reuses the first existing context when attached over CDP or to
+    a running Chrome, which would make every session share cookies and storage.
+    """
+
+    contexts: List[Any] = []
+
+    def __init__(self, playwright_browser):
+        self._playwright_browser = playwright_browser
+
+    def __getattr__(self, name):
+        return getattr(self._playwright_browser, name)
+
+@functools.lru_cache(maxsize=None)
+def traced_browser_context_class() -> type:
+    """Browser context class that traces DOM extraction"""
+    BrowserContext = lazy_import('browser_use.browser.context').BrowserContext
+
+    class TracedBrowserContext(BrowserContext):
+        async def get_state(self):
+            with tracer.start_as_current_span("browser.get_state"):
+                return await super().get_state()
+
+    return TracedBrowserContext
+
+@functools.lru_cache(maxsize=None)
+def isolated_browser_context_class() -> type:
+    """Browser context class that always gets its own cookies and storage"""
+    class IsolatedBrowserContext(traced_browser_context_class()):
+        async def _create_context(self, browser):
+            return await super()._create_context(_FreshContextsBrowser(browser))
+
+    return IsolatedBrowserContext
+
+@functools.lru_cache(maxsize=None)
+def service_agent_class() -> type:
+    """Agent class that traces each step and routes its LLM call through the step router"""
+    Agent = lazy_import('browser_use').Agent
+
+    class ServiceAgent(Agent):
+        async def step(self, step_info=None):
+            with tracer.start_as_current_span("agent.step", attributes={"agent.step": self.n_steps}) as span:
+                await super().step(step_info)
+                errors = [result.error for result in self._last_result or [] if result.error]
+                if errors:
+                    span.set_status(StatusCode.ERROR, errors[-1])
+
+        async def get_next_action(self, input_messages):
+            llm, reason = step_router.choose(self)
+            model = llm_model_name(llm)
+            step = self.n_steps
+            trace.get_current_span().set_attributes({"llm.model": model, "llm.route": reason})
+            agent_model = (self.llm, self.chat_model_library, self.model_name, self.tool_calling_method)
+            routed = llm is not self.llm
+            if routed:
+                # The routed model may be another provider, so it gets its own tool calling method
+                self.llm, self.chat_model_library, self.model_name = llm, type(llm).__name__, model
+                self.tool_calling_method = self.set_tool_calling_method('auto')
+                fallback_token = llm_step_fallback.set(agent_model[0])
+            early_dispatch = isinstance(self.controller, EarlyDispatchController)
+            if early_dispatch:
+                # A step that stopped before running its actions leaves its early action behind
+                await self.controller.wait_dispatched()
+                listener_token = llm_stream_listener.set(self._on_stream)
+            started = time.monotonic()
+            failed = True
+            try:
+                output = await super().get_next_action(input_messages)
+                failed = False
+                return output
+            finally:
+                if routed:
+                    llm_step_fallback.reset(fallback_token)
+                self.llm, self.chat_model_library, self.model_name, self.tool_calling_method = agent_model
+                seconds = time.monotonic() - started
+                if early_dispatch:
+                    llm_stream_listener.reset(listener_token)
+                    if self.controller.dispatched is not None:
+                        EARLY_ACTION_HEAD_START_SECONDS.observe(time.monotonic() - self._dispatched_at)
+                        if failed:
+                            # The action already ran; the next step sees its effect on the page
+                            await self.controller.wait_dispatched()
+                step_router.record(model, reason, seconds, failed)
+                logger.info("Agent step model", extra={"step": step, "model": model, "route": reason,
+                                                       "llm_seconds": seconds, "failed": failed})
+
+        def _on_stream(self, message):
+            """Dispatch the first action once a later one starts streaming, so it can't change any more"""
+            if self.controller.dispatched is not None or not message.tool_calls:
+                return
+            actions = (message.tool_calls[0]['args'] or {}).get('action') or []
+            if len(actions) < 2 or not isinstance(actions[0], dict):
+                return
+            try:
+                action = self.ActionModel(**actions[0])
+            except Exception:
+                return
+            self._dispatched_at = time.monotonic()
+            logger.debug("Dispatching action before the LLM finished", extra={"action": actions[0]})
+            self.controller.dispatched = (action.model_dump(exclude_unset=True), asyncio.create_task(self._act_early(action)))
+
+        async def _act_early(self, action) -> tuple:
+            session = await self.browser_context.get_session()
+            cached_path_hashes = set(e.hash.branch_path_hash for e in session.cached_state.selector_map.values())
+            await self.browser_context.remove_highlights()
+            result = await self.controller.act(action, self.browser_context, self.page_extraction_llm, self.sensitive_data)
+            return cached_path_hashes, result
+
+    return ServiceAgent
+
+@functools.lru_cache(maxsize=None)
+def traced_controller():
+    """Controller shared by all agents that traces each browser action"""
+    Controller = lazy_import('browser_use').Controller
+
+    class TracedController(Controller):
+        async def act(self, action, *args, **kwargs):
+            names = [name for name, params in action.model_dump(exclude_unset=True).items() if params is not None]
+            with tracer.start_as_current_span("browser.action", attributes={"browser.action": ",".join(names)}) as span:
+                result = await super().act(action, *args, **kwargs)
+                if result.error:
+                    span.set_status(StatusCode.ERROR, result.error)
+                return result
+
+    return TracedController()
+
+class EarlyDispatchController:
+    """Per-agent view of the shared controller that resumes a step whose first
+    action was already dispatched from the LLM stream"""
+
+    def __init__(self, controller):
+        self._controller = controller
+        self.dispatched: Optional[tuple] = None  # (first action as dumped, task returning (path hashes, result))
+
+    def __getattr__(self, name):
+        return getattr(self._controller, name)
+
+    async def wait_dispatched(self) -> Optional[tuple]:
+        """Let an early action finish and take it off the step"""
+        dispatched, self.dispatched = self.dispatched, None
+        if dispatched is None:
+            return None
+        first_action, task = dispatched
+        return (first_action, *await task)
+
+    async def multi_act(self, actions, browser_context, check_break_if_paused, check_for_new_elements=True,
+                        page_extraction_llm=None, sensitive_data=None):
+        dispatched = await self.wait_dispatched()
+        if dispatched is None:
+            return await self._controller.multi_act(actions, browser_context, check_break_if_paused,
+                                                    check_for_new_elements, page_extraction_llm, sensitive_data)
+        first_action, cached_path_hashes, first_result = dispatched
+        results = [first_result]
+        if not actions or actions[0].model_dump(exclude_unset=True) != first_action:
+            logger.warning("Early action doesn't match the parsed output; ending the step after it")
+            return results
+
+        # Same loop as browser_use's multi_act, from the second action on
+        for i, action in enumerate(actions[1:], start=1):
+            if results[-1].is_done or results[-1].error:
+                break
+            await asyncio.sleep(browser_context.config.wait_between_actions)
+            check_break_if_paused()
+            if action.get_index() is not None:
+                new_state = await browser_context.get_state()
+                new_path_hashes = set(e.hash.branch_path_hash for e in new_state.selector_map.values())
+                if check_for_new_elements and not new_path_hashes.issubset(cached_path_hashes):
+                    ActionResult = lazy_import('browser_use.agent.views').ActionResult
+                    msg = f'Something new appeared after action {i} / {len(actions)}'
+                    results.append(ActionResult(extracted_content=msg, include_in_memory=True))
+                    break
+            results.append(await self._controller.act(action, browser_context, page_extraction_llm, sensitive_data))
+        return results
+
+class SharedBrowser:
+    """A pooled browser hosting several session contexts"""
+
+    def __init__(self, browser: "Browser"):
+        self.browser = browser
+        self.contexts = 0
+
+class SharedBrowserContexts:
+    """Packs session contexts onto as few pooled browsers as possible"""
+
+    def __init__(self, max_contexts_per_browser: int = BROWSER_MAX_CONTEXTS_PER_BROWSER):
+        self.max_contexts_per_browser = max(1, max_contexts_per_browser)
+        self._browsers: List[SharedBrowser] = []
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> tuple:
+        """Open an isolated context on a shared browser, borrowing another browser when all are full"""
+        async with self._lock:
+            self._browsers = [shared for shared in self._browsers if self._keep(shared)]
+            candidates = [
+                shared for shared in self._browsers
+                if shared.contexts < self.max_contexts_per_browser and BrowserPool.is_healthy(shared.browser)
+            ]
+            if candidates:
+                # Fill the busiest browser first so fewer Chrome processes stay alive
+                shared = max(candidates, key=lambda candidate: candidate.contexts)
+            else:
+                shared = SharedBrowser(await browser_pool.acquire())
+                self._browsers.append(shared)
+            shared.contexts += 1
+
+        context = isolated_browser_context_class()(browser=shared.browser, config=shared.browser.config.new_context_config)
+        try:
+            await context.get_session()
+        except BaseException:
+            await self.release(shared.browser, context)
+            raise
+        return shared.browser, context
+
+    def _keep(self, shared: SharedBrowser) -> bool:
+        """Forget shared browsers that died while idle"""
+        if shared.contexts == 0 and not BrowserPool.is_healthy(shared.browser):
+            asyncio.create_task(browser_pool.release(shared.browser))
+            return False
+        return True
+
+    async def release(self, browser: "Browser", context: Optional["BrowserContext"], recycle: bool = False):
+        """Close a session's context and hand the browser back once its last context is gone"""
+        if context is not None:
+            try:
+                await asyncio.wait_for(context.close(), timeout=BROWSER_PROBE_TIMEOUT)
+            except Exception as e:
+                logger.warning("Error closing browser context", extra={"error": str(e)})
+
+        async with self._lock:
+            shared = next((shared for shared in self._browsers if shared.browser is browser), None)
+            if shared is None:
+                return
+            shared.contexts -= 1
+            if shared.contexts > 0:
+                return
+            self._browsers.remove(shared)
+        await browser_pool.release(browser, recycle=recycle)
+
+    def stats(self) -> Dict[str, Any]:
+        """Contexts hosted per shared browser"""
+        return {
+            "max_contexts_per_browser": self.max_contexts_per_browser,
+            "shared_browsers": len(self._browsers),
+            "contexts": sum(shared.contexts for shared in self._browsers),
+            "contexts_per_browser": [shared.contexts for shared in self._browsers],
+        }
+
+shared_contexts = SharedBrowserContexts()
+
+# Typed commands run directly against the session's page without the LLM.
+# Maps each command type to its required `data` fields.
+DIRECT_COMMAND_TYPES = {
+    "navigate": ["url"],
+    "click": ["selector"],
+    "type": ["selector", "text"],
+    "wait_for": ["selector"],
+    "extract_text": [],
+    "extract_html": [],
+}
+DIRECT_COMMAND_TIMEOUT = float(os.getenv('DIRECT_COMMAND_TIMEOUT', '30'))
+
+# Wall-clock and step bounds for a single command
+COMMAND_TIMEOUT = float(os.getenv('COMMAND_TIMEOUT', '600'))  # 0 disables the default timeout
+AGENT_MAX_STEPS = int(os.getenv('AGENT_MAX_STEPS', '20'))
+
 class Command(BaseModel):
     """Command to be executed in a browser session"""
-    prompt: str
+    prompt: Optional[str] = None
+    type: str = "custom"  # custom (AI agent) or one of DIRECT_COMMAND_TYPES
+    data: Dict[str, Any] = {}
     description: Optional[str] = None
     id: Optional[str] = None
+    priority: int = 0  # Higher runs first when SCHEDULER_PRIORITY_ENABLED is set
+    idempotent: bool = False  # Read-only; may share the result of an identical command
+    timeout_s: Optional[float] = None  # Run time limit, defaults to COMMAND_TIMEOUT
+    max_steps: Optional[int] = None  # Agent step limit, defaults to AGENT_MAX_STEPS
+    deadline: Optional[float] = None  # Unix time after which the caller no longer wants the result
+    _trace_context: Any = PrivateAttr(default=None)  # Caller's trace, from the request's traceparent header
+    _span: Any = PrivateAttr(default=None)
+
+class CommandStopped(Exception):
+    """A command was cancelled or ran past its timeout or deadline"""
+
+    def __init__(self, status: str, message: str):
+        super().__init__(message)
+        self.status = status
+
+def validate_command(command: Command):
+    """Reject commands with an unknown type or missing fields"""
+    if command.type == "custom":
+        if not command.prompt:
+            raise HTTPException(status_code=400, detail="Custom commands require a prompt")
+        return
+    if command.type not in DIRECT_COMMAND_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown command type: {command.type}")
+    missing = [field for field in DIRECT_COMMAND_TYPES[command.type] if not command.data.get(field)]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"{command.type} command requires data fields: {', '.join(missing)}")
+
+# Progress event streaming
+SESSION_EVENT_QUEUE_SIZE = int(os.getenv('SESSION_EVENT_QUEUE_SIZE', '100'))
+SESSION_EVENT_KEEPALIVE = float(os.getenv('SESSION_EVENT_KEEPALIVE', '15'))
+COMMAND_MAX_WAIT = float(os.getenv('COMMAND_MAX_WAIT', '60'))
+
+# Per-session command history retention
+COMMAND_HISTORY_RETENTION = int(os.getenv('COMMAND_HISTORY_RETENTION', '1000'))
+COMMAND_HISTORY_PAGE_LIMIT = 200
+
+class CommandStore:
+    """Bounded, id-indexed history of finished commands.
+
+    Keeps the most recent `retention` entries in a ring buffer so memory stays
+    flat for long-lived sessions. Every entry gets an increasing sequence
+    number that doubles as a pagination cursor.
+    """
+
+    def __init__(self, retention: int = COMMAND_HISTORY_RETENTION):
+        self.retention = max(1, retention)
+        self._entries: deque = deque(maxlen=self.retention)
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._next_seq = 0
+
+    def append(self, entry: Dict[str, Any]):
+        if len(self._entries) == self.retention:
+            evicted = self._entries[0]
+            if self._by_id.get(evicted["command_id"]) is evicted:
+                del self._by_id[evicted["command_id"]]
+        entry["seq"] = self._next_seq
+        self._next_seq += 1
+        self._entries.append(entry)
+        if entry["command_id"] is not None:
+            self._by_id[entry["command_id"]] = entry
+
+    def get(self, command_id: str) -> Optional[Dict[str, Any]]:
+        return self._by_id.get(command_id)
+
+    def last(self, count: int) -> List[Dict[str, Any]]:
+        start = max(0, len(self._entries) - count)
+        return list(itertools.islice(self._entries, start, None))
+
+    def page(self, cursor: Optional[int] = None, limit: int = 50) -> Dict[str, Any]:
+        """Entries after `cursor` (a previous `next_cursor`), oldest first.
+
+        `next_cursor` is also returned on the last page so callers can resume
+        from it once more commands have finished.
+        """
+        first_seq = self._next_seq - len(self._entries)
+        start = 0 if cursor is None else max(0, cursor + 1 - first_seq)
+        items = list(itertools.islice(self._entries, start, start + limit))
+        return {
+            "items": items,
+            "next_cursor": items[-1]["seq"] if items else cursor,
+            "has_more": bool(items) and items[-1]["seq"] < self._next_seq - 1,
+            "retained": len(self._entries),
+            "total": self._next_seq,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Record-and-replay cache of successful agent action traces
+ACTION_CACHE_ENABLED = os.getenv('ACTION_CACHE_ENABLED', 'False').lower() == 'true'
+ACTION_CACHE_MAX_ENTRIES = int(os.getenv('ACTION_CACHE_MAX_ENTRIES', '500'))
+
+# URLs, double-quoted strings and numbers (ids, dates) vary between runs of the same prompt
+_PROMPT_VALUE = re.compile(r'https?://[^\s"\'<>]*[^\s"\'<>.,;:!?)]|"([^"]*)"|\b\d+(?:[./:-]\d+)*\b')
+
+def prompt_template(prompt: str) -> tuple:
+    """Split a prompt into a normalized template and the values that fill it"""
+    values = []
+
+    def slot(match):
+        values.append(match.group(1) if match.group(1) is not None else match.group(0))
+        return "{}"
+
+    template = " ".join(re.sub(r"[^\w{}]+", " ", _PROMPT_VALUE.sub(slot, prompt).lower()).split())
+    return template, values
+
+def url_origin(url: Optional[str]) -> str:
+    parts = urlsplit(url or "")
+    return f"{parts.scheme}://{parts.netloc}" if parts.netloc else (url or "")
+
+def substitute_values(value: Any, replacements: List[tuple]) -> Any:
+    """Swap recorded prompt values for the current ones inside action parameters"""
+    if isinstance(value, str):
+        for old, new in replacements:
+            value = re.sub(rf"(?<![\w]){re.escape(old)}(?![\w])", lambda _: new, value)
+        return value
+    if isinstance(value, dict):
+        return {key: substitute_values(item, replacements) for key, item in value.items()}
+    if isinstance(value, list):
+        return [substitute_values(item, replacements) for item in value]
+    return value
+
+class ActionTrace:
+    """The successful steps of an agent run, recorded for replay"""
+
+    def __init__(self, values: List[str], steps: List[tuple], duration: float):
+        self.values = values
+        self.steps = steps  # (agent brain, action dicts, browser state) per step
+        self.duration = duration
+        self.replays = 0
+
+    @classmethod
+    def from_history(cls, history: "AgentHistoryList", values: List[str], duration: float) -> Optional["ActionTrace"]:
+        """Keep the actions that actually ran, skipping steps that failed"""
+        steps = []
+        for item in history.history:
+            if not item.model_output or any(result.error for result in item.result):
+                continue
+            executed = len(item.result)
+            if item.result and (item.result[-1].extracted_content or "").startswith("Something new appeared"):
+                # browser_use stopped before this action because the page changed
+                executed -= 1
+            # The final answer belongs to the recorded run, so `done` is never kept
+            kept = [
+                (action.model_dump(exclude_none=True), element)
+                for action, element in zip(item.model_output.action[:executed], item.state.interacted_element[:executed])
+                if 'done' not in action.model_dump(exclude_unset=True)
+            ]
+            if kept:
+                actions, elements = (list(column) for column in zip(*kept))
+                state = dataclasses.replace(item.state, interacted_element=elements, screenshot=None)
+                # Neither is the agent's reasoning, which can quote the recorded page
+                brain = item.model_output.current_state.model_copy(
+                    update={"page_summary": "", "evaluation_previous_goal": "", "memory": ""})
+                steps.append((brain, actions, state))
+        return cls(values, steps, duration) if steps else None
+
+    def history_for(self, agent, values: List[str]) -> "AgentHistoryList":
+        """Rebuild the trace as agent history, filled with the current prompt's values"""
+        views = lazy_import('browser_use.agent.views')
+        replacements = sorted(
+            ((old, new) for old, new in zip(self.values, values) if old != new),
+            key=lambda pair: len(pair[0]), reverse=True,
+        )
+        return views.AgentHistoryList(history=[
+            views.AgentHistory(
+                model_output=agent.AgentOutput(
+                    current_state=brain,
+                    action=[agent.ActionModel(**substitute_values(action, replacements)) for action in actions],
+                ),
+                result=[],
+                state=state,
+            )
+            for brain, actions, state in self.steps
+        ])
+
+class ActionCache:
+    """LRU of action traces keyed by prompt template and starting origin"""
+
+    def __init__(self, max_entries: int = ACTION_CACHE_MAX_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self._traces: "OrderedDict[tuple, ActionTrace]" = OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.recorded = 0
+        self.replays_succeeded = 0
+        self.replays_failed = 0
+        self.time_saved = 0.0
+
+    def lookup(self, key: tuple) -> Optional[ActionTrace]:
+        self.lookups += 1
+        trace = self._traces.get(key)
+        if trace is not None:
+            self.hits += 1
+            self._traces.move_to_end(key)
+        return trace
+
+    def record(self, key: tuple, history: "AgentHistoryList", values: List[str], duration: float):
+        """Store the trace of a finished agent run"""
+        if not history.is_done():
+            return
+        trace = ActionTrace.from_history(history, values, duration)
+        if trace is None:
+            return
+        self._traces[key] = trace
+        self._traces.move_to_end(key)
+        self.recorded += 1
+        while len(self._traces) > self.max_entries:
+            self._traces.popitem(last=False)
+
+    def replay_succeeded(self, trace: ActionTrace, duration: float):
+        trace.replays += 1
+        self.replays_succeeded += 1
+        self.time_saved += max(0.0, trace.duration - duration)
+
+    def replay_failed(self, key: tuple):
+        """Drop a trace that no longer matches the site so the agent records a new one"""
+        self.replays_failed += 1
+        self._traces.pop(key, None)
+
+    def clear(self):
+        self._traces.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit rate, replay success rate and agent time saved by replays"""
+        replays = self.replays_succeeded + self.replays_failed
+        return {
+            "enabled": ACTION_CACHE_ENABLED,
+            "entries": len(self._traces),
+            "max_entries": self.max_entries,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            "recorded": self.recorded,
+            "replays_succeeded": self.replays_succeeded,
+            "replays_failed": self.replays_failed,
+            "replay_success_rate": self.replays_succeeded / replays if replays else 0.0,
+            "time_saved": self.time_saved,
+        }
+
+action_cache = ActionCache()
+
+# Single-flight coalescing and result caching for idempotent commands
+COMMAND_RESULT_CACHE_TTL = float(os.getenv('COMMAND_RESULT_CACHE_TTL', '0'))  # 0 disables the cache
+COMMAND_RESULT_CACHE_MAX_ENTRIES = int(os.getenv('COMMAND_RESULT_CACHE_MAX_ENTRIES', '256'))
+
+class CommandCoalescer:
+    """Shares one run between identical idempotent commands.
+
+    A command whose key matches a run already in flight waits for that run's
+    result instead of starting its own. Successful results can also be kept
+    for a TTL in a size-bounded LRU cache.
+    """
+
+    def __init__(self, ttl: float = COMMAND_RESULT_CACHE_TTL, max_entries: int = COMMAND_RESULT_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._in_flight: Dict[tuple, asyncio.Future] = {}
+        self._results: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.runs = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+        self.cache_evictions = 0
+
+    def _cached(self, key: tuple) -> Optional[Dict[str, Any]]:
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        expires_at, result = entry
+        if expires_at < time.monotonic():
+            del self._results[key]
+            return None
+        self._results.move_to_end(key)
+        return result
+
+    def _store(self, key: tuple, result: Dict[str, Any]):
+        if self.ttl <= 0 or result.get("status") != "success":
+            return
+        self._results[key] = (time.monotonic() + self.ttl, result)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+            self.cache_evictions += 1
+
+    async def run(self, key: tuple, command_id: str, execute) -> Dict[str, Any]:
+        """Return a cached or in-flight result for `key`, or run `execute` and share its result"""
+        cached = self._cached(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return {**cached, "command_id": command_id, "cached": True}
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self.coalesced += 1
+            # Shielded so a follower being cancelled doesn't cancel the shared run
+            result = await asyncio.shield(in_flight)
+            return {**result, "command_id": command_id, "coalesced": True}
+
+        future = asyncio.get_running_loop().create_future()
+        # Followers re-raise the run's exception; don't warn when there were none
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        self._in_flight[key] = future
+        self.runs += 1
+        try:
+            result = await execute()
+        except BaseException as e:
+            future.set_exception(e if isinstance(e, Exception) else RuntimeError("Shared command run was cancelled"))
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        future.set_result(result)
+        self._store(key, result)
+        return result
+
+    def clear(self):
+        self._results.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """In-flight runs, coalesced commands and result cache usage"""
+        return {
+            "in_flight": len(self._in_flight),
+            "runs": self.runs,
+            "coalesced": self.coalesced,
+            "cache_ttl": self.ttl,
+            "cache_entries": len(self._results),
+            "cache_max_entries": self.max_entries,
+            "cache_hits": self.cache_hits,
+            "cache_evictions": self.cache_evictions,
+        }
+
+command_coalescer = CommandCoalescer()
 
 class SessionCreate(BaseModel):
     command: Command = None
@@ -197,7 +1992,8 @@ class BrowserSession:
     def __init__(self):
         self.session_id: Optional[str] = None
         self.status: str = "initialized"
-        self.browser: Optional[Browser] = None
+        self.browser: Optional["Browser"] = None
+        self.browser_context: Optional["BrowserContext"] = None
         self.agent = None
         self.result = None
         self.error = None
@@ -205,46 +2001,81 @@ class BrowserSession:
         self.updated_at = self.created_at
         self.command_queue = deque()
         self.current_command = None
-        self.command_history = []
+        self.command_history = CommandStore()
+        # Single consumer that drains command_queue in FIFO order
+        self._worker: Optional[asyncio.Task] = None
+        self._enqueued_at: Dict[str, float] = {}
+        self.commands_dequeued = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.last_queue_wait: Optional[float] = None
+        # Progress event subscribers (WebSocket/SSE streams) and long-poll waiters
+        self._subscribers: List[asyncio.Queue] = []
+        self._command_done: Dict[str, asyncio.Event] = {}
+        self._shares_browser = False
+        # Task running the current command, so it can be cancelled on its own
+        self._command_task: Optional[asyncio.Task] = None
+        self._cancel_requested: Optional[str] = None
 
     async def start(self, session_id: str):
         """Initialize browser session"""
         self.session_id = session_id
-        # Create a persistent browser instance
-        self.browser = get_browser()
+        await self._acquire_browser()
         self._update_state()
 
+    async def _acquire_browser(self):
+        if BROWSER_SHARING_MODE == 'context':
+            # Open an isolated context on a shared browser
+            self.browser, self.browser_context = await shared_contexts.acquire()
+            self._shares_browser = True
+        else:
+            # Borrow a warm browser from the pool instead of launching one
+            self.browser = await browser_pool.acquire()
+            self._shares_browser = False
+
+    async def _release_browser(self, recycle: bool = False):
+        """Return the browser (or this session's context on it) to the pool"""
+        if self.browser:
+            if self._shares_browser:
+                try:
+                    await shared_contexts.release(self.browser, self.browser_context, recycle=recycle)
+                except Exception as e:
+                    logger.warning("Error releasing browser", extra={"error": str(e)})
+            else:
+                # A hung or dead context must not keep the browser out of the pool
+                if self.browser_context is not None:
+                    try:
+                        await asyncio.wait_for(self.browser_context.close(), timeout=BROWSER_PROBE_TIMEOUT)
+                    except Exception as e:
+                        logger.warning("Error closing browser context", extra={"error": str(e)})
+                        recycle = True
+                try:
+                    await browser_pool.release(self.browser, recycle=recycle)
+                except Exception as e:
+                    logger.warning("Error releasing browser", extra={"error": str(e)})
+        self.browser = None
+        self.browser_context = None
+
+    def get_browser_context(self) -> "BrowserContext":
+        """The session's browser context, opened on first use.
+
+        Agent and typed commands all run in this context, so pages, cookies and
+        navigation carry over from one command to the next.
+        """
+        if self.browser_context is None:
+            self.browser_context = traced_browser_context_class()(browser=self.browser, config=self.browser.config.new_context_config)
+        return self.browser_context
+
     async def ensure_healthy_browser(self) -> bool:
-        """Ensure browser is healthy and reinitialize if needed"""
+        """Replace the session's browser if it has crashed or stopped answering"""
+        if self.browser is not None and await browser_pool.probe(self.browser):
+            return True
+        logger.warning("Session browser is dead, replacing it")
+        await self._release_browser(recycle=True)
+        await self._acquire_browser()
+        browser_pool.restarts += 1
+        self.publish("browser_restarted")
         return True
-        # try:
-        #     if not self.browser:
-        #         print("Debug: No browser instance exists, creating new one")
-        #         self.browser = get_browser()
-        #         return True
-            
-        #     # Try to access browser to check health
-        #     print("Debug: Checking browser health")
-        #     async with await self.browser.new_context() as context:
-        #         page = await context.new_page()
-        #         await page.goto('about:blank')
-        #         await page.close()
-        #     print("Debug: Browser health check passed")
-        #     return True
-            
-        # except Exception as e:
-        #     print(f"Debug: Browser health check failed: {str(e)}")
-        #     try:
-        #         # Clean up old browser
-        #         if self.browser:
-        #             await self.browser.close()
-        #     except:
-        #         pass
-            
-        #     # Create new browser
-        #     print("Debug: Reinitializing browser")
-        #     self.browser = get_browser()
-        #     return True
 
     def _update_state(self):
         """Update session state"""
@@ -259,112 +2090,132 @@ class BrowserSession:
             "created_at": self.created_at,
             "updated_at": self.updated_at,
             "command_queue_size": len(self.command_queue),
+            "worker_running": self.worker_running,
+            "queue_wait": {
+                "last": self.last_queue_wait,
+                "avg": self.queue_wait_total / self.commands_dequeued if self.commands_dequeued else None,
+                "max": self.queue_wait_max,
+            },
             "current_command": self.current_command.dict() if self.current_command else None,
-            "command_history": self.command_history[-5:] # Return last 5 commands
+            "command_history": self.command_history.last(5) # Return last 5 commands
         }
 
     async def add_command(self, command: Command) -> bool:
-        """Add a command to the session's queue"""
+        """Add a command to the session's queue and make sure the worker is draining it"""
         try:
+            # Spans the command from enqueue to finish, so queue wait is part of the trace
+            command._span = tracer.start_span("command", context=command._trace_context, attributes={
+                "session.id": self.session_id,
+                "command.id": command.id,
+                "command.type": command.type,
+            })
             self.command_queue.append(command)
+            self._enqueued_at[command.id] = time.monotonic()
+            self._update_state()
+            self.publish("command_queued", command_id=command.id, queue_position=len(self.command_queue))
+            self._ensure_worker()
             return True
         except Exception as e:
             self.error = f"Failed to add command: {str(e)}"
             return False
 
+    @property
+    def worker_running(self) -> bool:
+        return self._worker is not None and not self._worker.done()
+
+    @property
+    def is_idle(self) -> bool:
+        """No command running or queued"""
+        return not self.worker_running and not self.command_queue
+
+    def _ensure_worker(self):
+        """Start the command worker if it isn't already running"""
+        if not self.worker_running:
+            self._worker = asyncio.create_task(self._drain_queue())
+
+    async def _drain_queue(self):
+        """Run queued commands one at a time; exit once the queue is empty"""
+        log_session_id.set(self.session_id)
+        while self.command_queue:
+            await self.execute_next_command()
+
+    def _record_queue_wait(self, command: Command) -> Optional[float]:
+        """Time a command spent queued before the worker picked it up"""
+        enqueued_at = self._enqueued_at.pop(command.id, None)
+        if enqueued_at is None:
+            return None
+        waited = time.monotonic() - enqueued_at
+        self.commands_dequeued += 1
+        self.queue_wait_total += waited
+        self.queue_wait_max = max(self.queue_wait_max, waited)
+        self.last_queue_wait = waited
+        COMMAND_QUEUE_WAIT_SECONDS.observe(waited)
+        if command._span is not None:
+            tracer.start_span("command.queue_wait", context=trace.set_span_in_context(command._span),
+                              start_time=time.time_ns() - int(waited * 1e9)).end()
+        return waited
+
     async def execute_next_command(self) -> Dict[str, Any]:
         """Execute the next command in the queue"""
-        print("\n=== Starting execute_next_command ===")
         if not self.command_queue:
-            print("Debug: No commands in queue")
             return {"status": "no_commands"}
 
+        queue_wait = None
+        span_token = None
+        usage_token = command_llm_usage.set(new_llm_usage())
         try:
-            print("Debug: Retrieving next command from queue")
             self.current_command = self.command_queue.popleft()
-            print(f"Debug: Current command: {self.current_command}")
-            
-            self.status = "running"
+            log_command_id.set(self.current_command.id)
+            if self.current_command._span is not None:
+                span_token = otel_context.attach(trace.set_span_in_context(self.current_command._span))
+            queue_wait = self._record_queue_wait(self.current_command)
+            logger.info("Command started", extra={"command_type": self.current_command.type, "queue_wait": queue_wait})
+            logger.debug("Command details", extra={"command": self.current_command.dict()})
+            self.status = "waiting"
             self._update_state()
-  
-            # Ensure browser is healthy
-            print("Debug: Ensuring browser health")
-            # if not await self.ensure_healthy_browser():
-            #     raise Exception("Failed to ensure healthy browser")
-
-            print("Debug: Creating new context for agent")
-            print("Debug: Initializing agent")
-            llm = get_llm()
-            print("Debug: self browser" + str(self.browser))
-            self.agent = Agent(
-                llm=llm,
-                sensitive_data={},
-                task=self.current_command.prompt,
-                browser=self.browser,
-                use_vision=False,
-                save_conversation_path="./logs/browser-conversation"
-            )
 
-            print("Debug: Running agent")
-            agent_result = await self.agent.run(max_steps=20)
-            
-            print(f"Debug: Agent execution completed")
-            print(f"Debug: Agent result type: {type(agent_result)}")
-            print(f"Debug: Agent result: {agent_result}")
-            
-            # Process result
-            actions = []
-            summary = ""
-            
-            print("Debug: Processing agent result")
-            if agent_result:
-                if isinstance(agent_result, (list, tuple)):
-                    print("Debug: Processing list/tuple result")
-                    actions = [str(action) for action in agent_result]
-                    summary = " ".join(actions)
-                elif isinstance(agent_result, str):
-                    print("Debug: Processing string result")
-                    summary = agent_result
-                    actions = [agent_result]
-                else:
-                    print(f"Debug: Processing unknown result type: {type(agent_result)}")
-                    try:
-                        summary = str(agent_result)
-                        actions = [summary]
-                    except Exception as e:
-                        print(f"Debug: Error converting result: {str(e)}")
-                        summary = f"Error converting result: {str(e)}"
-                        actions = []
-            
-            history = await self.agent.run()
-            last_url = history.urls()[-1]
-            self.result = {
-                "status": "success",
-                "command_id": self.current_command.id,
-                "actions": actions,
-                "summary": summary,
-                "last_url": last_url
-            }
-            # print(f"Debug: Final result: {self.result}")
+            time_left = self._time_left(self.current_command)
+            if time_left is not None and time_left <= 0:
+                raise CommandStopped("timeout", "Command deadline passed before it started")
+            # Run in its own task so DELETE can cancel just this command
+            self._command_task = asyncio.create_task(self._execute_current_command())
+            try:
+                self.result = await asyncio.wait_for(self._command_task, timeout=time_left)
+            except asyncio.TimeoutError:
+                raise CommandStopped("timeout", f"Command did not finish within {time_left:.1f}s")
+            except asyncio.CancelledError:
+                if self._cancel_requested != self.current_command.id:
+                    raise
+                raise CommandStopped("cancelled", "Command was cancelled")
+            finally:
+                self._command_task = None
+                self._cancel_requested = None
 
-            # Update history
-            print("Debug: Updating command history")
-            self.command_history.append({
-                "command": self.current_command.dict(),
-                "command_id": self.current_command.id,
-                "result": self.result,
-                "timestamp": datetime.now().isoformat()
-            })
-            
             self.error = None
             self.status = "ready"
             self._update_state()
-            
-            print("=== Completed execute_next_command successfully ===\n")
+
+            # Update history
+            self._finish_command(queue_wait)
+            logger.info("Command completed", extra={"status": self.result.get("status")})
+            return self.result
+
+        except CommandStopped as e:
+            logger.info("Command stopped", extra={"status": e.status, "reason": str(e)})
+            ERRORS_TOTAL.labels('command', e.status).inc()
+            self.status = "ready"
+            self.result = {
+                "status": e.status,
+                "message": str(e),
+                "command_id": self.current_command.id,
+            }
+            self._update_state()
+            self._finish_command(queue_wait)
             return self.result
 
         except Exception as e:
-            print(f"\nDebug: Error in execute_next_command: {str(e)}")
+            logger.exception("Command failed")
+            ERRORS_TOTAL.labels('command', type(e).__name__).inc()
             error_msg = str(e)
             self.status = "error"
             self.error = error_msg
@@ -376,34 +2227,736 @@ class BrowserSession:
                 "command_id": self.current_command.id if self.current_command else None
             }
             
-            print(f"Debug: Error result: {self.result}")
-            self.command_history.append({
-                "command": self.current_command.dict() if self.current_command else None,
-                "command_id": self.current_command.id if self.current_command else None,
-                "result": self.result,
-                "timestamp": datetime.now().isoformat()
-            })
-            
             self._update_state()
-            print("=== Completed execute_next_command with error ===\n")
+            self._finish_command(queue_wait)
             return self.result
 
-    def get_command_history(self) -> List[Dict[str, Any]]:
-        """Get the history of executed commands"""
-        return self.command_history
+        finally:
+            command_llm_usage.reset(usage_token)
+            if span_token is not None:
+                otel_context.detach(span_token)
+
+    def _time_left(self, command: Command) -> Optional[float]:
+        """Seconds the command may still run, from its timeout and the caller's deadline"""
+        limits = []
+        timeout = command.timeout_s if command.timeout_s is not None else COMMAND_TIMEOUT
+        if timeout > 0:
+            limits.append(timeout)
+        if command.deadline is not None:
+            limits.append(command.deadline - time.time())
+        return min(limits) if limits else None
+
+    async def _execute_current_command(self) -> Dict[str, Any]:
+        # Swap out a crashed browser now rather than failing the command slowly
+        await self.ensure_healthy_browser()
+
+        if self.current_command.idempotent:
+            key = await self._coalescing_key(self.current_command)
+            return await command_coalescer.run(key, self.current_command.id, self._run_current_command)
+        return await self._run_current_command()
+
+    def cancel_command(self, command_id: str) -> Optional[str]:
+        """Cancel a queued or running command; returns the state it was in, None if neither"""
+        for command in self.command_queue:
+            if command.id == command_id:
+                self.command_queue.remove(command)
+                self._enqueued_at.pop(command_id, None)
+                self._finish_command(None, command=command, result={
+                    "status": "cancelled",
+                    "message": "Command was cancelled before it started",
+                    "command_id": command_id,
+                })
+                return "queued"
+        if self.current_command and self.current_command.id == command_id and self._command_task:
+            self._cancel_requested = command_id
+            self._command_task.cancel()
+            return "running"
+        return None
+
+    async def _run_current_command(self) -> Dict[str, Any]:
+        """Run the current command with an agent, or directly for typed commands"""
+        if self.current_command.type == "custom":
+            return await self._run_agent_command()
+        # Typed commands skip the LLM, so they don't need an agent slot
+        self.status = "running"
+        self._update_state()
+        self.publish("command_started", command_id=self.current_command.id)
+        with tracer.start_as_current_span("browser.action", attributes={"browser.action": self.current_command.type}):
+            return await self._run_direct_command(self.current_command)
+
+    async def _coalescing_key(self, command: Command) -> tuple:
+        """Commands with the same key produce the same result and can share a run"""
+        _, values = prompt_template(command.prompt or "")
+        return (
+            command.type,
+            command.prompt,
+            json.dumps(command.data, sort_keys=True),
+            await self._starting_url(values),
+            (LLM_PROVIDER, LLM_MODEL, LLM_TEMPERATURE),
+        )
 
-    async def cleanup(self):
-        """Clean up browser resources"""
-        if self.browser:
+    async def _run_agent_command(self) -> Dict[str, Any]:
+        """Run the current command's prompt through a browser_use agent"""
+        # Wait for a global agent slot so bursts can't launch unbounded agents
+        self.status = "waiting"
+        self._update_state()
+        async with scheduler.agent_slot(self.current_command.priority):
+            self.status = "running"
+            self._update_state()
+            self.publish("command_started", command_id=self.current_command.id)
+
+            llm = get_llm()
+            cache_key = None
+            if ACTION_CACHE_ENABLED:
+                template, values = prompt_template(self.current_command.prompt)
+                cache_key = (template, url_origin(await self._starting_url(values)))
+                trace = action_cache.lookup(cache_key)
+                if trace is not None:
+                    replayed = await self._replay_trace(cache_key, trace, values, llm)
+                    if replayed is not None:
+                        return replayed
+
+            self.agent = service_agent_class()(
+                llm=llm,
+                controller=EarlyDispatchController(traced_controller()) if LLM_STREAMING and LLM_EARLY_DISPATCH else traced_controller(),
+                sensitive_data={},
+                task=self.current_command.prompt,
+                browser=self.browser,
+                browser_context=self.get_browser_context(),
+                use_vision=False,
+                register_new_step_callback=self._on_agent_step
+            )
+            if conversation_log_sink.should_record():
+                conversation_log_sink.attach(self.agent, self.session_id, self.current_command.id)
+
+            logger.debug("Running agent", extra={"prompt": self.current_command.prompt})
+            started = time.monotonic()
+            agent_result = await self.agent.run(max_steps=self.current_command.max_steps or AGENT_MAX_STEPS)
+            AGENT_RUN_SECONDS.observe(time.monotonic() - started)
+            if cache_key is not None:
+                action_cache.record(cache_key, agent_result, values, time.monotonic() - started)
+
+        result = self._build_result(agent_result)
+        logger.debug("Agent finished", extra={"steps": result["steps"], "is_done": result["is_done"],
+                                              "summary": result["summary"], "errors": result["errors"]})
+        return result
+
+    async def _starting_url(self, values: List[str]) -> str:
+        """The first URL in the prompt, else the page the session is on"""
+        url = next((value for value in values if value.startswith(("http://", "https://"))), None)
+        if url is None:
+            page = await self.get_browser_context().get_current_page()
+            url = page.url
+        return url
+
+    async def _replay_trace(self, cache_key: tuple, trace: ActionTrace, values: List[str], llm) -> Optional[Dict[str, Any]]:
+        """Replay a recorded trace without planning; None if any step fails validation"""
+        logger.info("Replaying cached action trace", extra={"steps": len(trace.steps), "template": cache_key[0]})
+        started = time.monotonic()
+        agent = service_agent_class()(
+            llm=llm,
+            controller=traced_controller(),
+            task=self.current_command.prompt,
+            browser=self.browser,
+            browser_context=self.get_browser_context(),
+            use_vision=False,
+        )
+        try:
+            history = trace.history_for(agent, values)
+            # Elements are re-located by their recorded DOM position; a missing one raises
+            results = await agent.rerun_history(history, max_retries=1, skip_failures=False, delay_between_actions=0)
+            actions = [action.model_dump(exclude_none=True) for item in history.history for action in item.model_output.action]
+            if len(results) != len(actions) or any(
+                result.error or (result.extracted_content or "").startswith("Something new appeared") for result in results
+            ):
+                raise ValueError("Replayed actions diverged from the recorded trace")
+            # The answer always comes from the live page: the trace's own extraction
+            # steps re-read it, and traces without one get a final extraction for the task
+            summary = ""
+            for action, result in zip(actions, results):
+                if "extract_content" in action:
+                    summary = result.extracted_content or ""
+            if not summary:
+                extract = agent.ActionModel(extract_content={"goal": self.current_command.prompt})
+                result = await agent.controller.act(extract, self.get_browser_context(), page_extraction_llm=llm)
+                summary = result.extracted_content or ""
+                actions.append(extract.model_dump(exclude_none=True))
+        except Exception as e:
+            logger.info("Replay failed, falling back to the agent", extra={"error": str(e)})
+            action_cache.replay_failed(cache_key)
+            return None
+        action_cache.replay_succeeded(trace, time.monotonic() - started)
+
+        page = await self.get_browser_context().get_current_page()
+        return {
+            "status": "success",
+            "command_id": self.current_command.id,
+            "is_done": True,
+            "summary": summary,
+            "actions": actions,
+            "urls": [page.url],
+            "last_url": page.url,
+            "errors": [],
+            "steps": len(history.history),
+            "replayed": True,
+        }
+
+    async def _run_direct_command(self, command: Command) -> Dict[str, Any]:
+        """Run a typed command straight against the session's current page"""
+        context = self.get_browser_context()
+        data = command.data
+        timeout = float(data.get("timeout", DIRECT_COMMAND_TIMEOUT)) * 1000
+        selector = data.get("selector")
+        summary = ""
+
+        if command.type == "navigate":
+            await context.navigate_to(data["url"])
+            page = await context.get_current_page()
+        else:
+            page = await context.get_current_page()
+            if command.type == "click":
+                await page.click(selector, timeout=timeout)
+                await page.wait_for_load_state(timeout=timeout)
+            elif command.type == "type":
+                await page.fill(selector, data["text"], timeout=timeout)
+            elif command.type == "wait_for":
+                await page.wait_for_selector(selector, state=data.get("state", "visible"), timeout=timeout)
+            elif command.type == "extract_text":
+                summary = await page.inner_text(selector or "body", timeout=timeout)
+            elif command.type == "extract_html":
+                if selector:
+                    summary = await page.locator(selector).first.evaluate("element => element.outerHTML", timeout=timeout)
+                else:
+                    summary = await page.content()
+
+        return {
+            "status": "success",
+            "command_id": command.id,
+            "type": command.type,
+            "is_done": True,
+            "summary": summary,
+            "url": page.url,
+            "title": await page.title(),
+        }
+
+    def _finish_command(self, queue_wait: Optional[float], command: Optional[Command] = None,
+                        result: Optional[Dict[str, Any]] = None):
+        """Record a command's result (the current one by default) and notify streams and long-poll waiters"""
+        command = command or self.current_command
+        result_is_current = result is None
+        result = result if result is not None else self.result
+        command_id = command.id if command else None
+        usage = command_llm_usage.get()
+        if command is not None and command is self.current_command and usage and usage["calls"]:
+            result = {**result, "llm_usage": dict(usage)}
+            if result_is_current:
+                self.result = result
+            logger.info("Command LLM usage", extra=usage)
+            if command._span is not None:
+                for key, value in usage.items():
+                    command._span.set_attribute(f"llm.{key}", value)
+        entry = {
+            "command": command.dict() if command else None,
+            "command_id": command_id,
+            "result": result,
+            "queue_wait": queue_wait,
+            "timestamp": datetime.now().isoformat()
+        }
+        self.command_history.append(entry)
+        if command and command._span is not None:
+            status = result.get("status", "unknown")
+            command._span.set_attribute("command.status", status)
+            if status != "success":
+                command._span.set_status(StatusCode.ERROR, result.get("message"))
+            command._span.end()
+        COMMANDS_TOTAL.labels(command.type if command else "unknown", result.get("status", "unknown")).inc()
+        self.publish("command_completed", command_id=command_id, result=result)
+        done = self._command_done.pop(command_id, None)
+        if done:
+            done.set()
+
+    def _on_agent_step(self, state, model_output, step: int):
+        """Publish a progress event after the agent picks its next actions"""
+        self.publish(
+            "step",
+            command_id=self.current_command.id if self.current_command else None,
+            step=step,
+            url=state.url,
+            title=state.title,
+            next_goal=model_output.current_state.next_goal,
+            actions=[action.model_dump(exclude_none=True) for action in model_output.action],
+        )
+
+    def publish(self, event_type: str, **data):
+        """Send an event to every subscriber, dropping the oldest event for slow ones"""
+        event = {"type": event_type, "session_id": self.session_id, "timestamp": datetime.now().isoformat(), **data}
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def subscribe(self) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=SESSION_EVENT_QUEUE_SIZE)
+        self._subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self._subscribers:
+            self._subscribers.remove(queue)
+
+    def find_command(self, command_id: str) -> Optional[Dict[str, Any]]:
+        """Get the history entry of a finished command"""
+        return self.command_history.get(command_id)
+
+    def pending_command_state(self, command_id: str) -> Optional[str]:
+        """'queued' or 'running' for a command that hasn't finished, None if unknown"""
+        if self.current_command and self.current_command.id == command_id and self.status in ("waiting", "running"):
+            return "running"
+        if command_id in self._enqueued_at:
+            return "queued"
+        return None
+
+    def has_command(self, command_id: str) -> bool:
+        """Whether the command is queued, running or in the retained history"""
+        return self.find_command(command_id) is not None or self.pending_command_state(command_id) is not None
+
+    async def wait_for_command(self, command_id: str, timeout: float) -> Optional[Dict[str, Any]]:
+        """Wait up to `timeout` seconds for a queued or running command to finish"""
+        entry = self.find_command(command_id)
+        if entry is None and timeout > 0 and self.pending_command_state(command_id):
+            done = self._command_done.setdefault(command_id, asyncio.Event())
             try:
-                await self.browser.close()
-            except Exception as e:
-                print(f"Error closing browser: {str(e)}")
-        self.browser = None
+                await asyncio.wait_for(done.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            entry = self.find_command(command_id)
+        return entry
+
+    async def events(self, command_id: Optional[str] = None):
+        """Yield progress events, or None when idle for the keepalive interval.
+
+        With a command id, only that command's events are yielded and the
+        stream ends once it completes.
+        """
+        queue = self.subscribe()
+        try:
+            if command_id:
+                entry = self.find_command(command_id)
+                if entry is not None:
+                    yield {"type": "command_completed", "session_id": self.session_id,
+                           "timestamp": entry["timestamp"], "command_id": command_id, "result": entry["result"]}
+                    return
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SESSION_EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if event["type"] == "session_closed":
+                    yield event
+                    return
+                if command_id and event.get("command_id") != command_id:
+                    continue
+                yield event
+                if command_id and event["type"] == "command_completed":
+                    return
+        finally:
+            self.unsubscribe(queue)
+
+    def _build_result(self, history: "AgentHistoryList") -> Dict[str, Any]:
+        """Build a compact result from the agent's run history in a single pass"""
+        actions = []
+        urls = []
+        errors = []
+        for item in history.history:
+            url = item.state.url
+            if url and (not urls or urls[-1] != url):
+                urls.append(url)
+            if item.model_output:
+                actions.extend(action.model_dump(exclude_none=True) for action in item.model_output.action)
+            errors.extend(result.error for result in item.result if result.error)
+
+        final_result = history.final_result()
+        return {
+            "status": "success",
+            "command_id": self.current_command.id,
+            "is_done": history.is_done(),
+            "summary": final_result or "",
+            "actions": actions,
+            "urls": urls,
+            "last_url": urls[-1] if urls else None,
+            "errors": errors,
+            "steps": len(history.history),
+            "replayed": False,
+        }
+
+    def get_command_history(self, cursor: Optional[int] = None, limit: int = 50) -> Dict[str, Any]:
+        """Get a page of the history of executed commands"""
+        return self.command_history.page(cursor, limit)
+
+    async def cleanup(self, recycle: bool = False):
+        """Return the browser (or this session's context on it) to the pool"""
+        # Queued commands will never run; finish them so their spans end and waiters see a final state
+        while self.command_queue:
+            command = self.command_queue.popleft()
+            self._enqueued_at.pop(command.id, None)
+            self._finish_command(None, command=command, result={
+                "status": "cancelled",
+                "message": "Session closed before the command started",
+                "command_id": command.id,
+            })
+        self.publish("session_closed")
+        for done in self._command_done.values():
+            done.set()
+        self._command_done.clear()
+        if self.worker_running:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except (asyncio.CancelledError, Exception):
+                pass
+        self._worker = None
+        await self._release_browser(recycle=recycle)
 
 # Store active sessions in memory
 sessions: Dict[str, BrowserSession] = {}
 
+# Idle session reaping
+SESSION_IDLE_TTL = float(os.getenv('SESSION_IDLE_TTL', '900'))  # 0 keeps idle sessions forever
+SESSION_REAPER_INTERVAL = float(os.getenv('SESSION_REAPER_INTERVAL', '30'))
+BROWSER_RSS_LIMIT_MB = float(os.getenv('BROWSER_RSS_LIMIT_MB', '0'))  # 0 disables memory-pressure eviction
+
+def browser_processes_rss() -> int:
+    """Resident memory in bytes of this service's child processes (Playwright and Chrome).
+
+    Read from /proc, so it is 0 on platforms without it and doesn't cover a
+    remote Chrome attached over CDP.
+    """
+    if not os.path.isdir('/proc'):
+        return 0
+    children: Dict[int, List[int]] = {}
+    rss_pages: Dict[int, int] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            with open(f'/proc/{entry}/statm') as f:
+                rss_pages[int(entry)] = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total = 0
+    stack = list(children.get(os.getpid(), []))
+    while stack:
+        pid = stack.pop()
+        total += rss_pages.get(pid, 0)
+        stack.extend(children.get(pid, []))
+    return total * os.sysconf('SC_PAGE_SIZE')
+
+class SessionReaper:
+    """Closes sessions left idle past SESSION_IDLE_TTL, and the least recently
+    used idle sessions while browser memory is above BROWSER_RSS_LIMIT_MB"""
+
+    def __init__(self, idle_ttl: float = SESSION_IDLE_TTL, interval: float = SESSION_REAPER_INTERVAL,
+                 rss_limit_mb: float = BROWSER_RSS_LIMIT_MB):
+        self.idle_ttl = idle_ttl
+        self.interval = max(1.0, interval)
+        self.rss_limit = int(rss_limit_mb * 1024 * 1024)
+        self._task: Optional[asyncio.Task] = None
+        self.idle_evictions = 0
+        self.memory_evictions = 0
+        self.reclaimed_bytes = 0
+        self.last_rss = 0
+
+    def start(self):
+        if self._task is None and (self.idle_ttl > 0 or self.rss_limit > 0):
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reap()
+            except Exception as e:
+                logger.exception("Session reaper error")
+
+    def _idle_sessions(self) -> List[tuple]:
+        """Idle sessions as (seconds idle, session id), least recently used first"""
+        now = datetime.now()
+        idle = [
+            ((now - datetime.fromisoformat(browser_session.updated_at)).total_seconds(), session_id)
+            for session_id, browser_session in sessions.items()
+            if browser_session.is_idle
+        ]
+        return sorted(idle, reverse=True)
+
+    async def reap(self):
+        """Run one pass of TTL and memory-pressure eviction"""
+        if self.idle_ttl > 0:
+            for idle_for, session_id in self._idle_sessions():
+                if idle_for > self.idle_ttl:
+                    logger.info("Reaping idle session", extra={"session_id": session_id, "idle_seconds": idle_for})
+                    await self._evict(session_id)
+                    self.idle_evictions += 1
+
+        self.last_rss = await asyncio.to_thread(browser_processes_rss)
+        if self.rss_limit <= 0 or self.last_rss <= self.rss_limit:
+            return
+        for _, session_id in self._idle_sessions():
+            logger.info("Evicting session under memory pressure",
+                        extra={"session_id": session_id, "browser_rss_mb": self.last_rss / 2**20})
+            # Close its browser or context outright so the memory is actually freed
+            await self._evict(session_id, recycle=True)
+            self.memory_evictions += 1
+            self.last_rss = await asyncio.to_thread(browser_processes_rss)
+            if self.last_rss <= self.rss_limit:
+                break
+
+    async def _evict(self, session_id: str, recycle: bool = False):
+        browser_session = sessions.pop(session_id, None)
+        if browser_session is None:
+            return
+        before = await asyncio.to_thread(browser_processes_rss)
+        await browser_session.cleanup(recycle=recycle)
+        self.reclaimed_bytes += max(0, before - await asyncio.to_thread(browser_processes_rss))
+
+    def stats(self) -> Dict[str, Any]:
+        """Eviction counts and memory reclaimed"""
+        return {
+            "idle_ttl": self.idle_ttl,
+            "rss_limit_mb": self.rss_limit / 2**20,
+            "browser_rss_mb": self.last_rss / 2**20,
+            "idle_evictions": self.idle_evictions,
+            "memory_evictions": self.memory_evictions,
+            "reclaimed_mb": self.reclaimed_bytes / 2**20,
+        }
+
+session_reaper = SessionReaper()
+
+CONVERSATION_LOG_MODE = os.getenv('CONVERSATION_LOG_MODE', 'all')  # Options: all, sample, off
+CONVERSATION_LOG_SAMPLE_RATE = float(os.getenv('CONVERSATION_LOG_SAMPLE_RATE', '0.1'))
+CONVERSATION_LOG_DIR = os.getenv('CONVERSATION_LOG_DIR', './logs/browser-conversation')
+CONVERSATION_LOG_BATCH_SIZE = int(os.getenv('CONVERSATION_LOG_BATCH_SIZE', '50'))
+CONVERSATION_LOG_FLUSH_INTERVAL = float(os.getenv('CONVERSATION_LOG_FLUSH_INTERVAL', '5'))
+CONVERSATION_LOG_QUEUE_SIZE = int(os.getenv('CONVERSATION_LOG_QUEUE_SIZE', '1000'))
+CONVERSATION_LOG_MAX_AGE = float(os.getenv('CONVERSATION_LOG_MAX_AGE', str(7 * 24 * 3600)))  # 0 keeps files forever
+CONVERSATION_LOG_MAX_MB = float(os.getenv('CONVERSATION_LOG_MAX_MB', '500'))  # 0 disables the size cap
+
+def serialize_conversation_step(step: Dict[str, Any]) -> str:
+    """One JSON line for an agent step's input messages and model output"""
+    response = step["response"]
+    return json.dumps({
+        "timestamp": step["timestamp"],
+        "step": step["step"],
+        "messages": [
+            {"type": message.type, "content": message.content,
+             **({"tool_calls": message.tool_calls} if getattr(message, "tool_calls", None) else {})}
+            for message in step["messages"]
+        ],
+        "response": response.model_dump(exclude_unset=True) if hasattr(response, "model_dump") else response,
+    }, default=str)
+
+class ConversationLogSink:
+    """Writes agent conversations off the event loop in gzip batches, one file
+    per session and command, pruned by age and total size"""
+
+    def __init__(self, mode: str = CONVERSATION_LOG_MODE, sample_rate: float = CONVERSATION_LOG_SAMPLE_RATE,
+                 directory: str = CONVERSATION_LOG_DIR, batch_size: int = CONVERSATION_LOG_BATCH_SIZE,
+                 flush_interval: float = CONVERSATION_LOG_FLUSH_INTERVAL, queue_size: int = CONVERSATION_LOG_QUEUE_SIZE,
+                 max_age: float = CONVERSATION_LOG_MAX_AGE, max_mb: float = CONVERSATION_LOG_MAX_MB):
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.1, flush_interval)
+        self.queue_size = queue_size
+        self.max_age = max_age
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._pending: List[tuple] = []
+        self._batch_ready = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.commands_recorded = 0
+        self.commands_skipped = 0
+        self.steps_written = 0
+        self.steps_dropped = 0
+        self.bytes_written = 0
+        self.batches = 0
+        self.write_errors = 0
+        self.pruned_files = 0
+        self.pruned_bytes = 0
+        self.disk_bytes = 0
+
+    def start(self):
+        if self._task is None and self.mode != 'off':
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Stop the writer after flushing what is still queued"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def should_record(self) -> bool:
+        """Decide once per command whether its conversation is kept"""
+        if self.mode == 'all':
+            record = True
+        elif self.mode == 'sample':
+            record = random.random() < self.sample_rate
+        else:
+            record = False
+        if record:
+            self.commands_recorded += 1
+        else:
+            self.commands_skipped += 1
+        return record
+
+    def attach(self, agent, session_id: str, command_id: str):
+        """Route an agent's per-step conversation dump into the sink"""
+        filename = f"{session_id}_{command_id}.jsonl.gz"
+
+        def save_conversation(input_messages, response):
+            self.record(filename, {
+                "timestamp": datetime.now().isoformat(),
+                "step": agent.n_steps,
+                "messages": list(input_messages),
+                "response": response,
+            })
+
+        # browser_use calls this after every step; the default writes synchronously
+        agent._save_conversation = save_conversation
+
+    def record(self, filename: str, step: Dict[str, Any]):
+        """Queue a step for the next batch; dropped rather than blocking when the queue is full"""
+        if len(self._pending) >= self.queue_size:
+            self.steps_dropped += 1
+            return
+        self._pending.append((filename, step))
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def _run(self):
+        await asyncio.to_thread(self._prune)
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("Conversation log flush error")
+
+    async def flush(self):
+        """Write queued steps and apply retention"""
+        batch, self._pending = self._pending, []
+        if batch:
+            await asyncio.to_thread(self._write_batch, batch)
+            await asyncio.to_thread(self._prune)
+
+    def _write_batch(self, batch: List[tuple]):
+        by_file: Dict[str, List[str]] = {}
+        for filename, step in batch:
+            try:
+                by_file.setdefault(filename, []).append(serialize_conversation_step(step))
+            except Exception as e:
+                self.write_errors += 1
+                logger.warning("Could not serialize conversation step", extra={"error": str(e)})
+        os.makedirs(self.directory, exist_ok=True)
+        for filename, lines in by_file.items():
+            data = gzip.compress(("\n".join(lines) + "\n").encode())
+            try:
+                # Each batch is appended as its own gzip member; gzip readers concatenate them
+                with open(os.path.join(self.directory, filename), 'ab') as f:
+                    f.write(data)
+            except OSError as e:
+                self.write_errors += 1
+                ERRORS_TOTAL.labels('conversation_log', type(e).__name__).inc()
+                logger.warning("Could not write conversation log", extra={"file": filename, "error": str(e)})
+                continue
+            self.steps_written += len(lines)
+            self.bytes_written += len(data)
+        self.batches += 1
+
+    def _prune(self):
+        """Delete files older than max_age, then the oldest until under max_bytes"""
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        except OSError:
+            return
+        files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path) for entry in entries)
+        total = sum(size for _, size, _ in files)
+        cutoff = time.time() - self.max_age
+        for mtime, size, path in files:
+            expired = self.max_age > 0 and mtime < cutoff
+            over_size = self.max_bytes > 0 and total > self.max_bytes
+            if not expired and not over_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.pruned_files += 1
+            self.pruned_bytes += size
+        self.disk_bytes = total
+
+    def stats(self) -> Dict[str, Any]:
+        """Sampling, write and retention counters"""
+        return {
+            "mode": self.mode,
+            "sample_rate": self.sample_rate if self.mode == 'sample' else None,
+            "directory": self.directory,
+            "commands_recorded": self.commands_recorded,
+            "commands_skipped": self.commands_skipped,
+            "queued": len(self._pending),
+            "steps_written": self.steps_written,
+            "steps_dropped": self.steps_dropped,
+            "batches": self.batches,
+            "write_errors": self.write_errors,
+            "written_mb": self.bytes_written / 2**20,
+            "disk_mb": self.disk_bytes / 2**20,
+            "max_mb": self.max_bytes / 2**20,
+            "pruned_files": self.pruned_files,
+            "pruned_mb": self.pruned_bytes / 2**20,
+        }
+
+conversation_log_sink = ConversationLogSink()
+
+@app.on_event("startup")
+async def start_browser_pool():
+    """Pre-launch pooled browsers when the service starts"""
+    logger.info("Service starting", extra={"module_load_seconds": MODULE_LOAD_TIME})
+    await browser_pool.start()
+    session_reaper.start()
+    conversation_log_sink.start()
+
+@app.on_event("shutdown")
+async def close_browser_pool():
+    """Close pooled browsers when the service stops"""
+    await session_reaper.close()
+    for browser_session in list(sessions.values()):
+        await browser_session.cleanup()
+    await browser_pool.close()
+    await conversation_log_sink.close()
+
 @app.get("/", response_class=HTMLResponse)
 async def get_debug_ui():
     """Return debug UI showing all sessions"""
@@ -714,7 +3267,7 @@ LLM_TEMPERATURE: {LLM_TEMPERATURE}
             let savedPrompts = JSON.parse(localStorage.getItem('savedPrompts') || '[]');
             
             // Load default prompts if they don't exist in localStorage
-            const defaultPrompts = """ + json.dumps(DEFAULT_PROMPTS) + """;
+            const defaultPrompts = """ + json.dumps(get_default_prompts()) + """;
             defaultPrompts.forEach(defaultPrompt => {
                 if (!savedPrompts.some(p => p.name === defaultPrompt.name)) {
                     savedPrompts.push(defaultPrompt);
@@ -1159,70 +3712,171 @@ LLM_TEMPERATURE: {LLM_TEMPERATURE}
     
     return HTMLResponse(content=html)
 
+def admit_command():
+    """Reject new commands with 429 once the global backlog is full"""
+    backlog = sum(len(browser_session.command_queue) for browser_session in sessions.values())
+    try:
+        scheduler.check_admission(backlog)
+    except SchedulerBacklogFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
 @app.post("/browser-agent/session")
-async def create_session(data: SessionCreate):
+async def create_session(request: Request, data: SessionCreate, x_request_deadline: Optional[float] = Header(None)):
     """Create a new browser session"""
+    if data.command:
+        validate_command(data.command)
+        admit_command()
+    trace_context = propagate.extract(request.headers)
     try:
         session_id = str(uuid.uuid4())
         browser_session = BrowserSession()
-        await browser_session.start(session_id)
+        with SESSION_CREATE_SECONDS.time(), tracer.start_as_current_span(
+            "session.create", context=trace_context, attributes={"session.id": session_id}
+        ):
+            await browser_session.start(session_id)
         sessions[session_id] = browser_session
         
-        print("executing data" +  str(data))
+        log_session_id.set(session_id)
+        logger.debug("Create session request", extra={"request": data.dict()})
         # If initial prompt provided, add command to queue but don't wait for execution
         command_id = None
+        trace_id = None
         if data.command:
-            print(f"Creating session with prompt: {data.command.prompt}")
-            command = Command(prompt=data.command.prompt)
+            command = data.command.copy(update={"deadline": command_deadline(data.command, x_request_deadline)})
             # Assign a UUID to the command
             command.id = str(uuid.uuid4())
+            command._trace_context = trace_context
             command_id = command.id
+            # Queue the command; the session's worker runs it in the background
             await browser_session.add_command(command)
-            
-            # Start command execution in background without awaiting the result
-            asyncio.create_task(browser_session.execute_next_command())
+            trace_id = span_trace_id(command._span)
         
         return {
             "session_id": session_id,
             "status": "initialized",
-            "command_id": command_id
+            "command_id": command_id,
+            "trace_id": trace_id
         }
+    except BrowserPoolExhausted as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        print("getting create session error" + str(e))
+        logger.exception("Error creating session")
         raise HTTPException(status_code=500, detail=str(e))
 
+def command_deadline(command: Command, header_deadline: Optional[float]) -> Optional[float]:
+    """The earlier of the command's own deadline and the X-Request-Deadline header"""
+    deadlines = [deadline for deadline in (command.deadline, header_deadline) if deadline is not None]
+    return min(deadlines) if deadlines else None
+
 @app.post("/browser-agent/{session_id}/command")
-async def send_command(session_id: str, command: Command):
+async def send_command(request: Request, session_id: str, command: Command, x_request_deadline: Optional[float] = Header(None)):
     """Send a command to an existing session"""
     if session_id not in sessions:
         raise HTTPException(status_code=404, detail="Session not found")
     
     browser_session = sessions[session_id]
+    validate_command(command)
+    admit_command()
     
     # Assign a UUID to the command if it doesn't have one
     if not command.id:
         command.id = str(uuid.uuid4())
+    command.deadline = command_deadline(command, x_request_deadline)
+    command._trace_context = propagate.extract(request.headers)
     
-    # Add command to queue
+    # Add command to queue; the session's worker runs it in the background
     add_result = await browser_session.add_command(command)
     
-    # Start command execution in background without awaiting the result
-    asyncio.create_task(browser_session.execute_next_command())
-    
     return {
         "status": "success",
         "command_id": command.id,
-        "session_id": session_id
+        "session_id": session_id,
+        "trace_id": span_trace_id(command._span)
     }
 
 @app.get("/browser-agent/{session_id}/commands")
-async def get_command_history(session_id: str):
-    """Get command history for a session"""
+async def get_command_history(session_id: str, cursor: Optional[int] = None, limit: int = 50):
+    """Get a page of command history for a session, oldest first"""
     if session_id not in sessions:
         raise HTTPException(status_code=404, detail="Session not found")
     
     browser_session = sessions[session_id]
-    return browser_session.get_command_history()
+    return browser_session.get_command_history(cursor, min(max(limit, 1), COMMAND_HISTORY_PAGE_LIMIT))
+
+@app.get("/browser-agent/{session_id}/commands/{command_id}")
+async def get_command(session_id: str, command_id: str, wait: float = 0):
+    """Get a command's result, long-polling up to `wait` seconds for it to finish"""
+    if session_id not in sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    browser_session = sessions[session_id]
+    entry = await browser_session.wait_for_command(command_id, min(max(wait, 0), COMMAND_MAX_WAIT))
+    if entry is not None:
+        return {**entry, "state": "completed"}
+
+    state = browser_session.pending_command_state(command_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Command not found")
+    return {"command_id": command_id, "state": state, "result": None}
+
+@app.delete("/browser-agent/{session_id}/commands/{command_id}")
+async def cancel_command(session_id: str, command_id: str):
+    """Cancel a queued or running command"""
+    if session_id not in sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    browser_session = sessions[session_id]
+    cancelled_state = browser_session.cancel_command(command_id)
+    if cancelled_state is None:
+        if browser_session.find_command(command_id) is not None:
+            raise HTTPException(status_code=409, detail="Command already finished")
+        raise HTTPException(status_code=404, detail="Command not found")
+
+    # A running agent stops at its next await; wait briefly so the reply reflects it
+    entry = await browser_session.wait_for_command(command_id, BROWSER_PROBE_TIMEOUT)
+    return {
+        "status": "success",
+        "command_id": command_id,
+        "cancelled_state": cancelled_state,
+        "result": entry["result"] if entry else None,
+    }
+
+@app.get("/browser-agent/{session_id}/events")
+async def stream_session_events(session_id: str, command_id: Optional[str] = None):
+    """Stream a session's (or a single command's) progress as server-sent events"""
+    if session_id not in sessions:
+        raise HTTPException(status_code=404, detail="Session not found")
+    # A stream for an unknown command would never see it complete
+    if command_id and not sessions[session_id].has_command(command_id):
+        raise HTTPException(status_code=404, detail="Command not found")
+
+    async def event_stream():
+        async for event in sessions[session_id].events(command_id):
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.websocket("/browser-agent/{session_id}/ws")
+async def session_websocket(websocket: WebSocket, session_id: str, command_id: Optional[str] = None):
+    """Stream a session's (or a single command's) progress over a WebSocket"""
+    if session_id not in sessions:
+        await websocket.close(code=4404, reason="Session not found")
+        return
+    if command_id and not sessions[session_id].has_command(command_id):
+        await websocket.close(code=4404, reason="Command not found")
+        return
+
+    await websocket.accept()
+    try:
+        async for event in sessions[session_id].events(command_id):
+            await websocket.send_json(event if event is not None else {"type": "keepalive"})
+        await websocket.close()
+    except WebSocketDisconnect:
+        pass
 
 @app.get("/browser-agent/{session_id}/state")
 async def get_session_state(session_id: str):
@@ -1236,14 +3890,86 @@ async def get_session_state(session_id: str):
 @app.delete("/browser-agent/{session_id}")
 async def end_session(session_id: str):
     """End a session"""
-    if session_id not in sessions:
+    # Pop before cleanup so the reaper can't evict the same session meanwhile
+    browser_session = sessions.pop(session_id, None)
+    if browser_session is None:
         raise HTTPException(status_code=404, detail="Session not found")
-    
-    browser_session = sessions[session_id]
     await browser_session.cleanup()
-    del sessions[session_id]
     return {"status": "success"}
 
+@app.get("/browser-agent/pool")
+async def get_pool_stats():
+    """Get browser pool size, hit/miss counts and wait times"""
+    return {
+        **browser_pool.stats(),
+        "sharing_mode": BROWSER_SHARING_MODE,
+        "shared": shared_contexts.stats(),
+    }
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus metrics"""
+    pool_stats = browser_pool.stats()
+    SESSIONS_GAUGE.set(len(sessions))
+    BROWSERS_GAUGE.labels('idle').set(pool_stats["idle"])
+    BROWSERS_GAUGE.labels('leased').set(pool_stats["leased"])
+    QUEUE_DEPTH_GAUGE.set(sum(len(browser_session.command_queue) for browser_session in sessions.values()))
+    AGENTS_RUNNING_GAUGE.set(scheduler.stats()["agents_running"])
+    LLM_IN_FLIGHT_GAUGE.set(scheduler.llm_in_flight)
+    CHROME_RSS_GAUGE.set(await asyncio.to_thread(browser_processes_rss))
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/browser-agent/reaper")
+async def get_reaper_stats():
+    """Get idle and memory-pressure session evictions and memory reclaimed"""
+    return session_reaper.stats()
+
+@app.get("/browser-agent/conversation-logs")
+async def get_conversation_log_stats():
+    """Get conversation log sampling, batched writes and retention"""
+    return conversation_log_sink.stats()
+
+@app.get("/browser-agent/startup")
+async def get_startup_report():
+    """Get server module load time and how long each lazily imported module took"""
+    return {
+        "module_load_time": MODULE_LOAD_TIME,
+        "imports": IMPORT_TIMINGS,
+    }
+
+@app.get("/browser-agent/scheduler")
+async def get_scheduler_stats():
+    """Get global agent and LLM concurrency, wait times and rejections"""
+    return {
+        **scheduler.stats(),
+        "backlog": sum(len(browser_session.command_queue) for browser_session in sessions.values()),
+    }
+
+@app.get("/browser-agent/rate-limits")
+async def get_rate_limit_stats():
+    """Get LLM request and token budgets, queue wait and throttling per provider model"""
+    return rate_limiter.stats()
+
+@app.get("/browser-agent/hedging")
+async def get_hedging_stats():
+    """Get LLM hedge and failover counts, hedge delay and extra token spend"""
+    return {**llm_hedger.stats(), "routed": routed_llm_hedger.stats()}
+
+@app.get("/browser-agent/routing")
+async def get_routing_stats():
+    """Get per-model step counts, failures and LLM latency, and how often each routing rule fired"""
+    return step_router.stats()
+
+@app.get("/browser-agent/action-cache")
+async def get_action_cache_stats():
+    """Get record-and-replay cache hit rate, replay success rate and time saved"""
+    return action_cache.stats()
+
+@app.get("/browser-agent/coalescing")
+async def get_coalescing_stats():
+    """Get shared runs of idempotent commands and result cache usage"""
+    return command_coalescer.stats()
+
 @app.get("/browser-agent/sessions")
 async def list_sessions():
     """List all active sessions"""
@@ -1276,14 +4002,18 @@ async def reset_config(config: ChromeConfig):
     CHROME_CDP_URL = config.chrome_cdp_url or f'http://{CHROME_HOST}:{CHROME_PORT}'
     HEADLESS = config.headless
     DEBUG = config.debug
+    logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
     
-    # Close any existing browser instances
-    for session_id, session in sessions.items():
-        if session.browser:
-            await session.browser.close()
-    
-    # Clear all sessions
+    # Clear all sessions first so the reaper can't evict them meanwhile, then close their browsers
+    stale_sessions = list(sessions.values())
     sessions.clear()
+    for session in stale_sessions:
+        await session.cleanup(recycle=True)
+
+    # Drop pooled browsers built with the old configuration
+    await browser_pool.reset()
+    action_cache.clear()
+    command_coalescer.clear()
     
     return {
         "status": "success",
@@ -1312,7 +4042,9 @@ async def update_llm_config(config: LLMConfig):
     LLM_PROVIDER = config.provider
     LLM_MODEL = config.model
     LLM_TEMPERATURE = config.temperature
-    
+    # The cache is keyed by provider, model and temperature, so the next get_llm()
+    # builds the new model; the old one stays pooled for agents still using it
+
     return {
         "status": "success",
         "message": "LLM configuration updated successfully",
@@ -1321,4 +4053,7 @@ async def update_llm_config(config: LLMConfig):
             "model": LLM_MODEL,
             "temperature": LLM_TEMPERATURE
         }
-    } 
\ No newline at end of file
+    }
+
+# Time spent importing this module, reported with the lazy import timings
+MODULE_LOAD_TIME = time.perf_counter() - _MODULE_LOAD_STARTED
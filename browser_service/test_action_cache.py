@@ -0,0 +1,93 @@
+"""Action replay cache tests. Run with: python -m pytest test_action_cache.py"""
+import asyncio
+import os
+import types
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import server
+from browser_use.agent.views import ActionResult, AgentBrain, AgentHistory, AgentHistoryList, AgentOutput
+from browser_use.browser.views import BrowserStateHistory
+from browser_use.controller.service import Controller
+
+ActionModel = Controller().registry.create_action_model()
+Output = AgentOutput.type_with_custom_actions(ActionModel)
+
+INTAKE_PROMPT = "go to {url} and open the most recent Revolution New Patient Intake Form and return it"
+
+def step(url, actions, results):
+    brain = AgentBrain(page_summary=f"Intake form on {url}", evaluation_previous_goal="Success",
+                       memory="Patient Alice Smith, DOB 1970-01-01", next_goal="Return the form")
+    return AgentHistory(
+        model_output=Output(current_state=brain, action=[ActionModel(**action) for action in actions]),
+        result=results,
+        state=BrowserStateHistory(url=url, title="Intake", tabs=[], interacted_element=[None] * len(actions)),
+    )
+
+def recorded_run(url):
+    """An agent run for patient A that answers with `done` instead of an extraction step"""
+    return AgentHistoryList(history=[
+        step(url, [{"go_to_url": {"url": url}}], [ActionResult()]),
+        step(url, [{"done": {"text": "Patient Alice Smith, DOB 1970-01-01, allergies: penicillin"}}],
+             [ActionResult(is_done=True, extracted_content="Patient Alice Smith, DOB 1970-01-01, allergies: penicillin")]),
+    ])
+
+class FakeAgent:
+    """Replays actions against a fake page whose content depends on the URL"""
+
+    def __init__(self, **kwargs):
+        self.ActionModel = ActionModel
+        self.AgentOutput = Output
+        self.page = types.SimpleNamespace(url="about:blank", title=self.title)
+        self.controller = types.SimpleNamespace(act=self.act)
+
+    async def title(self):
+        return "Intake"
+
+    async def act(self, action, browser_context, page_extraction_llm=None):
+        params = action.model_dump(exclude_unset=True)
+        if "go_to_url" in params:
+            self.page.url = params["go_to_url"]["url"]
+            return ActionResult()
+        if "extract_content" in params:
+            return ActionResult(extracted_content=f"Live form from {self.page.url}: Patient Bob Jones")
+        if "done" in params:
+            return ActionResult(is_done=True, extracted_content=params["done"]["text"])
+        raise AssertionError(f"Unexpected action {params}")
+
+    async def rerun_history(self, history, **kwargs):
+        return [await self.act(action, None) for item in history.history for action in item.model_output.action]
+
+def test_trace_does_not_keep_recorded_answer():
+    url = "https://ehr.example.com/patients/1"
+    cache = server.ActionCache()
+    template, values = server.prompt_template(INTAKE_PROMPT.format(url=url))
+    cache.record((template, server.url_origin(url)), recorded_run(url), values, 10.0)
+
+    trace = cache.lookup((template, server.url_origin(url)))
+    assert trace is not None
+    assert all("done" not in action for _, actions, _ in trace.steps for action in actions)
+    assert "Alice" not in repr(trace.steps)
+
+def test_replay_for_another_patient_reads_the_live_page(monkeypatch):
+    first, second = "https://ehr.example.com/patients/1", "https://ehr.example.com/patients/2"
+    first_template, first_values = server.prompt_template(INTAKE_PROMPT.format(url=first))
+    second_template, second_values = server.prompt_template(INTAKE_PROMPT.format(url=second))
+    assert first_template == second_template
+    key = (first_template, server.url_origin(first))
+    monkeypatch.setattr(server, "action_cache", server.ActionCache())
+    server.action_cache.record(key, recorded_run(first), first_values, 10.0)
+
+    agent = FakeAgent()
+    monkeypatch.setattr(server, "service_agent_class", lambda: lambda **kwargs: agent)
+    session = server.BrowserSession()
+    session.current_command = server.Command(prompt=INTAKE_PROMPT.format(url=second), id="c2")
+    session.get_browser_context = lambda: types.SimpleNamespace(get_current_page=lambda: asyncio.sleep(0, agent.page))
+
+    result = asyncio.run(session._replay_trace(key, server.action_cache.lookup(key), second_values, llm=None))
+
+    assert result["replayed"] is True
+    assert agent.page.url == second
+    assert "Bob Jones" in result["summary"]
+    assert "Alice" not in result["summary"]
+    assert "Alice" not in repr(result["actions"])
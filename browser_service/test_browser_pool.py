@@ -0,0 +1,49 @@
+"""Browser pool tests. Run with: python -m pytest test_browser_pool.py"""
+import asyncio
+import os
+
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import server
+
+class SlowLaunchBrowser:
+    """Stands in for a browser_use Browser whose launch never finishes on its own"""
+
+    launched = []
+
+    def __init__(self):
+        self.playwright_browser = None
+        self.closed = False
+        SlowLaunchBrowser.launched.append(self)
+
+    async def get_playwright_browser(self):
+        await asyncio.sleep(60)
+
+    async def close(self):
+        self.closed = True
+
+def test_cancelled_launch_returns_its_slot(monkeypatch):
+    monkeypatch.setattr(server, "get_browser", SlowLaunchBrowser)
+    SlowLaunchBrowser.launched.clear()
+    pool = server.BrowserPool(min_size=0, max_size=2, acquire_timeout=0.1)
+
+    async def cancel_mid_launch():
+        task = asyncio.create_task(pool.acquire())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def run():
+        for _ in range(pool.max_size):
+            await cancel_mid_launch()
+        assert pool._size == 0
+        # The pool still has room to launch, so this waits on a launch rather than failing as exhausted
+        await cancel_mid_launch()
+        assert pool._size == 0
+
+    asyncio.run(run())
+    assert all(browser.closed for browser in SlowLaunchBrowser.launched)
+    assert pool.launch_failures == 0
@@ -2,6 +2,7 @@ import { QueueManager } from '../core/usecases/queue-manager';
 import { WorkflowUseCases } from '../core/usecases/workflow-usecases';
 import { Task, TaskStatus } from '../core/entities/task';
 import { v4 as uuidv4 } from 'uuid';
+import { randomBytes } from 'crypto';
 import { Logger } from '../utils/logger';
 import OpenAI from 'openai';
 import axios from 'axios';
@@ -481,10 +482,19 @@ export class CloudWorker {
   }
 
   private async executeBrowserCommand(prompt: string): Promise<any> {
+    const maxAttempts = 6;
+    const waitSeconds = 25;
+    // Tell the service when we stop waiting so it doesn't keep running the agent after that
+    const deadline = Date.now() / 1000 + maxAttempts * waitSeconds;
+    // W3C trace context so the service's spans for this command join our trace
+    const traceId = randomBytes(16).toString('hex');
+    const traceparent = `00-${traceId}-${randomBytes(8).toString('hex')}-01`;
+    this.logger.info(`Browser command trace: ${traceId}`);
+
     // Create a new browser session
     const commandResponse = await fetch('http://localhost:3000/api/browser-agent/browser-agent/session', {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
+      headers: { 'Content-Type': 'application/json', 'X-Request-Deadline': String(deadline), traceparent },
       body: JSON.stringify({ 
         command: { prompt }
       }),
@@ -501,51 +511,33 @@ export class CloudWorker {
       throw new Error('Invalid response from browser service: missing session_id or command_id');
     }
     
-    // Poll for command completion
-    const maxAttempts = 30;
+    // Long-poll the command until it finishes; the service answers as soon as it completes
     let attempts = 0;
     
     while (attempts < maxAttempts) {
-      this.logger.info(`Polling for command completion: ${attempts} of ${maxAttempts}`);
-      await new Promise(resolve => setTimeout(resolve, 5000));
+      this.logger.info(`Waiting for command completion: ${attempts} of ${maxAttempts}`);
       
-      const stateResponse = await fetch(`http://localhost:3000/api/browser-agent/browser-agent/${sessionId}/state`);
-      if (!stateResponse.ok) {
-        throw new Error(`Failed to get session state: ${stateResponse.statusText}`);
+      const commandStateResponse = await fetch(`http://localhost:3000/api/browser-agent/browser-agent/${sessionId}/commands/${commandId}?wait=${waitSeconds}`);
+      if (!commandStateResponse.ok) {
+        throw new Error(`Failed to get command state: ${commandStateResponse.statusText}`);
       }
       
-      const stateData = await stateResponse.json();
-      const commandHistory = stateData.command_history || [];
-      
-      // Check for completion
-      const completedCommand = commandHistory.find((cmd: { command_id: string, result: { status: string } }) => 
-        cmd.command_id === commandId && 
-        cmd.result && 
-        cmd.result.status === 'success'
-      );
-      
-      if (completedCommand) {
-        return completedCommand.result;
-      }
+      const commandState = await commandStateResponse.json();
       
-      // Check for failure
-      const failedCommand = commandHistory.find((cmd: { command_id: string, result: { status: string } }) => 
-        cmd.command_id === commandId && 
-        cmd.result && 
-        cmd.result.status === 'error'
-      );
-      
-      if (failedCommand) {
-        throw new Error(`Browser command failed: ${failedCommand.result.message || 'Unknown error'}`);
-      }
-      
-      if (stateData.status === 'error') {
-        throw new Error(`Browser session in error state: ${stateData.error || 'Unknown error'}`);
+      if (commandState.state === 'completed' && commandState.result) {
+        if (commandState.result.status === 'success') {
+          return commandState.result;
+        }
+        throw new Error(`Browser command failed: ${commandState.result.message || 'Unknown error'}`);
       }
       
       attempts++;
     }
     
+    // Cancel the command so it releases its agent and browser right away
+    await fetch(`http://localhost:3000/api/browser-agent/browser-agent/${sessionId}/commands/${commandId}`, {
+      method: 'DELETE',
+    }).catch(() => undefined);
     throw new Error('Browser command timed out after multiple attempts');
   }
 